@@ -2,7 +2,16 @@ import torch
 import torch.nn as nn
 import torch_geometric.nn as gnn
 from torch_scatter import scatter
+from typing import NamedTuple
 from utils import create_hyperedge_index
+from profiler import stage
+
+
+# clique expansion of a hypergraph, computed once and reused by every forward pass
+class Hypergraph(NamedTuple):
+    node_index: torch.Tensor  # metabolite gathered into each node instance
+    batch: torch.Tensor  # hyperedge of each node instance
+    edge_index: torch.Tensor  # clique edges between node instances
 
 
 class CHESHIRE(nn.Module):
@@ -18,16 +27,43 @@ class CHESHIRE(nn.Module):
         self.sigmoid = nn.Sigmoid()
 
     def forward(self, feature, incidence_matrix):
-        x = self.tanh(self.linear_encoder(feature))
-        x, hyperedge_index = self.partition(x, incidence_matrix)
-        edge_index, batch = self.expansion(hyperedge_index)
+        hypergraph = incidence_matrix
+        if not isinstance(hypergraph, Hypergraph):
+            hypergraph = self.prepare(incidence_matrix)
+        return self.score(self.encode(feature), hypergraph)
+
+    def encode(self, feature):
+        if feature.is_sparse:
+            x = torch.sparse.mm(feature, self.linear_encoder.weight.t()) + self.linear_encoder.bias
+            return self.tanh(x)
+        return self.tanh(self.linear_encoder(feature))
+
+    # score hyperedges from encoded node features; lets chunked scoring encode the nodes only once
+    def score(self, x, hypergraph):
+        x, batch = x[hypergraph.node_index, :], hypergraph.batch
         x = self.dropout(self.norm_emb(x, batch))
-        x = self.tanh(self.graph_conv(x, edge_index))
+        x = self.tanh(self.graph_conv(x, hypergraph.edge_index))
         y_maxmin = self.max_pool(x, batch) - self.min_pool(x, batch)
         y_norm = self.norm_pool(x, batch)
         y = torch.cat((y_maxmin, y_norm), dim=1)
         return self.sigmoid(self.linear(y))
 
+    @staticmethod
+    @stage('expansion')
+    def prepare(incidence_matrix):
+        node_index, hyperedge_index = CHESHIRE.partition(incidence_matrix)
+        edge_index, batch = CHESHIRE.expansion(hyperedge_index)
+        return Hypergraph(node_index, batch, edge_index)
+
+    # hypergraph of the column-wise concatenation of two incidence matrices
+    @staticmethod
+    def concat(hypergraph1, hypergraph2):
+        num_hyperedges = int(hypergraph1.batch.max().item() + 1) if len(hypergraph1.batch) > 0 else 0
+        node_index = torch.cat((hypergraph1.node_index, hypergraph2.node_index))
+        batch = torch.cat((hypergraph1.batch, hypergraph2.batch + num_hyperedges))
+        edge_index = torch.cat((hypergraph1.edge_index, hypergraph2.edge_index + len(hypergraph1.node_index)), dim=1)
+        return Hypergraph(node_index, batch, edge_index)
+
     @staticmethod
     def norm_pool(x, batch):
         size = int(batch.max().item() + 1)
@@ -41,32 +77,29 @@ class CHESHIRE(nn.Module):
 
     @staticmethod
     def expansion(hyperedge_index):
+        # node instances of a hyperedge form a contiguous segment; connect every ordered pair within a segment
         node_set = hyperedge_index[0]
-        index = hyperedge_index[1].int()
-        edge_index = torch.empty((2, 0), dtype=torch.int64)
-        batch = torch.empty(len(node_set), dtype=torch.int64)
-        for i in range(index[-1] + 1):
-            nodes = node_set[index == i]
-            batch[nodes.long()] = i
-            num_nodes = len(nodes)
-            adj_matrix = torch.ones(num_nodes, num_nodes) - torch.eye(num_nodes)
-            row, col = torch.where(adj_matrix)
-            row, col = nodes[row], nodes[col]
-            edge = torch.cat((row.view(1, -1), col.view(1, -1)), dim=0)
-            edge_index = torch.cat((edge_index, edge), dim=1)
+        batch = hyperedge_index[1].long()
+        counts = torch.bincount(batch)
+        ptr = torch.cumsum(counts, dim=0) - counts
+        num_pairs = counts * (counts - 1)
+        pair_batch = torch.repeat_interleave(torch.arange(len(counts)), num_pairs)
+        pair_index = torch.arange(int(num_pairs.sum())) - (torch.cumsum(num_pairs, dim=0) - num_pairs)[pair_batch]
+        degree = counts[pair_batch] - 1
+        row = torch.div(pair_index, degree, rounding_mode='floor')
+        col = torch.remainder(pair_index, degree)
+        col = col + (col >= row).long()
+        row, col = node_set[ptr[pair_batch] + row], node_set[ptr[pair_batch] + col]
+        edge_index = torch.stack((row, col), dim=0).long()
         return edge_index, batch
 
     @staticmethod
-    def partition(x, incidence_matrix):
+    def partition(incidence_matrix):
+        # one node instance per (metabolite, reaction) pair, laid out hyperedge by hyperedge
         hyperedge_index = create_hyperedge_index(incidence_matrix)
-        node_set, sort_index = torch.sort(hyperedge_index[0])
-        hyperedge_index[1] = hyperedge_index[1][sort_index]
-        x = x[node_set.long(), :]
+        node_index = hyperedge_index[0].clone()
         hyperedge_index[0] = torch.arange(0, len(hyperedge_index[0]))
-        index_set, sort_index = torch.sort(hyperedge_index[1])
-        hyperedge_index[1] = index_set
-        hyperedge_index[0] = hyperedge_index[0][sort_index]
-        return x, hyperedge_index
+        return node_index, hyperedge_index
 
 
 
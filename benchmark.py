@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from copy import deepcopy
+import numpy as np
+from scipy import sparse
+import torch
+import cobra
+import optlang
+import solvers
+
+# metabolites every synthetic GEM contains: the energy couples checked for EGCs and the parts of their
+# dissipation reactions, placed first so that they are the hubs of the network
+ENERGY_METABOLITES = ['atp_c', 'adp_c', 'nadh_c', 'nad_c', 'nadph_c', 'nadp_c', 'accoa_c', 'coa_c',
+                      'h2o_c', 'h_c', 'pi_c', 'ac_c']
+BENCHMARKS = ['partition', 'expansion', 'negative_sampling', 'epoch', 'scoring', 'similarity', 'similarity_dense_block',
+              'growth_inflation', 'resolve_egc', 'egc_checker', 'egc_screen',
+              'flux_balance_analysis']
+
+
+def parse():
+    parser = argparse.ArgumentParser(description='benchmark the hot paths of CHESHIRE on synthetic GEMs')
+    parser.add_argument('--num_reactions', type=str, default='500,2000')  # GEM sizes to benchmark, comma separated
+    parser.add_argument('--metabolite_ratio', type=float, default=0.8)  # metabolites per reaction
+    parser.add_argument('--num_candidates', type=float, default=2.0)  # pool reactions missing from the GEM, per GEM reaction
+    parser.add_argument('--degree', type=str, default='poisson', choices=['poisson', 'powerlaw'])  # reaction size distribution
+    parser.add_argument('--mean_degree', type=float, default=4.0)  # poisson: mean number of metabolites per reaction
+    parser.add_argument('--degree_exponent', type=float, default=2.5)  # powerlaw: P(size = k) ~ k ** -degree_exponent
+    parser.add_argument('--hub_exponent', type=float, default=1.0)  # metabolite popularity ~ 1 / rank ** hub_exponent
+    parser.add_argument('--benchmarks', type=str, default=','.join(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=3)  # timed runs per benchmark, after one warm-up run
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--solver', type=str, default='glpk')  # cplex, hybrid, glpk or auto, see solvers.py
+    parser.add_argument('--output', type=str, default='./results/benchmarks.jsonl')  # results are appended, one json per line
+    return parser.parse_args()
+
+
+# reactions of a random metabolic hypergraph as lists of (metabolite, coefficient). Reaction sizes follow
+# the degree distribution (at least two metabolites, at most half of all of them, as negative sampling
+# requires) and metabolites are drawn by popularity, so that a few hubs take part in many reactions.
+def synthetic_hypergraph(num_metabolites, num_reactions, mean_degree=4.0, degree='poisson', hub_exponent=1.0,
+                         degree_exponent=2.5, rng=None):
+    rng = np.random.default_rng() if rng is None else rng
+    max_size = num_metabolites // 2
+    if degree == 'poisson':
+        sizes = np.clip(2 + rng.poisson(max(mean_degree - 2, 0), num_reactions), 2, max_size)
+    else:
+        support = np.arange(2, max_size + 1)
+        sizes = rng.choice(support, num_reactions, p=support ** -degree_exponent / (support ** -degree_exponent).sum())
+    popularity = 1 / np.arange(1, num_metabolites + 1) ** hub_exponent
+    popularity /= popularity.sum()
+    reactions = []
+    for size in sizes:
+        mets = rng.choice(num_metabolites, size, replace=False, p=popularity)
+        num_reactants = rng.integers(1, size)
+        coefficients = rng.integers(1, 3, size).astype(float)
+        coefficients[:num_reactants] *= -1
+        reactions.append(list(zip(mets, coefficients)))
+    return reactions
+
+
+# a cobra model around a synthetic hypergraph that grows on its nutrients. A few metabolites are
+# nutrients with uptake, some can be secreted, and each biomass precursor gets a pathway from a nutrient
+# so that FBA is feasible. The last num_candidates reactions are returned separately as gap-filling
+# candidates, i.e. the pool is the model plus the candidates.
+def synthetic_model(num_reactions, num_candidates, metabolite_ratio=0.8, mean_degree=4.0, degree='poisson',
+                    hub_exponent=1.0, degree_exponent=2.5, seed=0):
+    rng = np.random.default_rng(seed)
+    num_metabolites = max(int((num_reactions + num_candidates) * metabolite_ratio), 2 * len(ENERGY_METABOLITES))
+    met_ids = ENERGY_METABOLITES + ['m%d_c' % i for i in range(num_metabolites - len(ENERGY_METABOLITES))]
+    metabolites = [cobra.Metabolite(mid, compartment='c') for mid in met_ids]
+
+    reactions = []
+    for j, stoichiometry in enumerate(synthetic_hypergraph(num_metabolites, num_reactions + num_candidates,
+                                                           mean_degree, degree, hub_exponent, degree_exponent, rng)):
+        rxn = cobra.Reaction('R%d' % j, lower_bound=-1000.0 if rng.random() < 0.5 else 0.0, upper_bound=1000.0)
+        rxn.add_metabolites({metabolites[i]: c for i, c in stoichiometry})
+        reactions.append(rxn)
+    model_reactions, candidates = reactions[:num_reactions], reactions[num_reactions:]
+
+    nutrients = rng.choice(np.arange(len(ENERGY_METABOLITES), num_metabolites), 5, replace=False)
+    secreted = rng.choice(np.arange(len(ENERGY_METABOLITES), num_metabolites), 10, replace=False)
+    precursors = rng.choice(np.arange(len(ENERGY_METABOLITES), num_metabolites), 5, replace=False)
+    for i in set(nutrients) | set(secreted):
+        met_e = cobra.Metabolite(met_ids[i][:-2] + '_e', compartment='e')
+        transport = cobra.Reaction('T_%s' % met_ids[i][:-2], lower_bound=-1000.0, upper_bound=1000.0)
+        transport.add_metabolites({met_e: -1.0, metabolites[i]: 1.0})
+        ex = cobra.Reaction('EX_' + met_e.id, lower_bound=-10.0 if i in nutrients else 0.0, upper_bound=1000.0)
+        ex.add_metabolites({met_e: -1.0})
+        model_reactions.extend([transport, ex])
+    for k, (n, p) in enumerate(zip(nutrients, precursors)):
+        rxn = cobra.Reaction('SUPPLY%d' % k, lower_bound=0.0, upper_bound=1000.0)
+        rxn.add_metabolites({metabolites[n]: -1.0, metabolites[p]: 1.0})
+        model_reactions.append(rxn)
+    biomass = cobra.Reaction('BIOMASS', lower_bound=0.0, upper_bound=1000.0)
+    biomass.add_metabolites({metabolites[p]: -1.0 for p in precursors})
+    model_reactions.append(biomass)
+
+    model = cobra.Model('synthetic_%d' % num_reactions)
+    model.add_reactions(model_reactions)
+    model.objective = 'BIOMASS'
+    targets = ['EX_%s_e' % met_ids[i][:-2] for i in secreted]
+    return model, candidates, targets
+
+
+# maximum absolute pearson correlation between each candidate column and the model columns, measured over
+# the metabolites involved in either set, from the full candidate-by-model block: the reference the similarity
+# index is measured against
+def max_correlation(candidate_matrix, model_matrix, chunk_size=1024):
+    from similarity import column_moments, count_rows, correlation_blocks
+    candidate_matrix, model_matrix = sparse.csc_matrix(candidate_matrix), sparse.csc_matrix(model_matrix)
+    candidate_matrix.eliminate_zeros()
+    model_matrix.eliminate_zeros()
+    num_rows = count_rows(candidate_matrix, model_matrix)
+    similarity_max = np.empty(candidate_matrix.shape[1])
+    for start, stop, corr in correlation_blocks(candidate_matrix, column_moments(candidate_matrix), model_matrix,
+                                                column_moments(model_matrix), num_rows, chunk_size):
+        similarity_max[start:stop] = np.abs(corr).max(axis=1)
+    return similarity_max
+
+
+# time fn over repeat runs after a warm-up run; setup builds fresh inputs for every run outside the timing
+def measure(fn, setup=None, repeat=3):
+    seconds = []
+    for r in range(repeat + 1):
+        inputs = setup() if setup is not None else ()
+        start = time.perf_counter()
+        fn(*inputs)
+        if r > 0:
+            seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'torch': torch.__version__,
+            'cobra': cobra.__version__, 'optlang': optlang.__version__, 'numpy': np.__version__,
+            'num_threads': torch.get_num_threads()}
+
+
+def run(num_reactions, settings):
+    # predict parses the command line when imported, so it is imported only once ours has been parsed
+    import predict
+    from CHESHIRE import CHESHIRE
+    from pool import ReactionPool
+    from similarity import SimilarityIndex
+    from utils import create_incidence_matrix, create_neg_incidence_matrix, unique_columns, create_label
+    from gapfilling import test_growth_inflation
+    from egc import resolve_egc, EGCChecker
+    from fba import flux_balance_analysis
+
+    num_candidates = int(num_reactions * settings.num_candidates)
+    model, candidates, targets = synthetic_model(num_reactions, num_candidates, settings.metabolite_ratio,
+                                                 settings.mean_degree, settings.degree, settings.hub_exponent,
+                                                 settings.degree_exponent, settings.seed)
+    solvers.configure(model, settings.solver)
+    universe = model.copy()
+    universe.add_reactions([rxn.copy() for rxn in candidates])
+    torch.manual_seed(settings.seed)
+
+    pool = ReactionPool(universe)
+    extended_pool = pool.extend(model)
+    rxn_matrix = extended_pool.columns(extended_pool.model_reactions)
+    rxn_pool_matrix, rxn_pool = extended_pool.candidates()
+    incidence_matrix_pos = unique_columns(create_incidence_matrix(rxn_matrix, dtype=torch.float))
+    incidence_matrix_cand = create_incidence_matrix(rxn_pool_matrix, dtype=torch.int64)
+    args = predict.args
+    cheshire = CHESHIRE(input_dim=incidence_matrix_pos.shape, emb_dim=args.emb_dim, conv_dim=args.conv_dim, k=args.k, p=args.p)
+    optimizer = torch.optim.Adam(cheshire.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    incidence_matrix_neg = unique_columns(create_neg_incidence_matrix(incidence_matrix_pos))
+    hypergraph = CHESHIRE.concat(CHESHIRE.prepare(incidence_matrix_pos), CHESHIRE.prepare(incidence_matrix_neg))
+    y = create_label(incidence_matrix_pos, incidence_matrix_neg)
+    hyperedge_index = CHESHIRE.partition(incidence_matrix_cand)[1]
+
+    def score():
+        for _ in predict.predict_chunks(incidence_matrix_pos, incidence_matrix_cand, [cheshire],
+                                        args.chunk_size, args.max_chunk_edges):
+            pass
+
+    # the index is built on every run, so the timing includes the pool-side moments
+    def similarity():
+        SimilarityIndex(pool).search(extended_pool, list(rxn_pool))
+
+    batch = [universe.reactions.get_by_id(rxn.id) for rxn in candidates[:10]]
+    egc_candidate = universe.reactions.get_by_id(candidates[0].id)
+    screened = [universe.reactions.get_by_id(rxn.id) for rxn in candidates[:100]]
+
+    def egc_setup():
+        gem = deepcopy(model)
+        gem.add_reactions([egc_candidate.copy()])
+        return gem, egc_candidate.id, 'bigg'
+
+    # the batch checked against one EGCChecker, as gap-filling does; building the checker is not timed
+    def egc_checker(checker):
+        for rxn in batch:
+            with checker.model:
+                checker.add([rxn])
+                checker.resolve(rxn.id)
+
+    benchmarks = {
+        'partition': (lambda: CHESHIRE.partition(incidence_matrix_cand), None),
+        'expansion': (lambda: CHESHIRE.expansion(hyperedge_index), None),
+        'negative_sampling': (lambda: create_neg_incidence_matrix(incidence_matrix_pos), None),
+        'epoch': (lambda: predict.train(incidence_matrix_pos, y, hypergraph, cheshire, optimizer), None),
+        'scoring': (score, None),
+        'similarity': (similarity, None),
+        'similarity_dense_block': (lambda: max_correlation(rxn_pool_matrix, rxn_matrix), None),
+        'growth_inflation': (test_growth_inflation, lambda: (deepcopy(model), batch)),
+        'resolve_egc': (resolve_egc, egc_setup),
+        'egc_checker': (egc_checker, lambda: (EGCChecker(model, 'bigg'),)),
+        'egc_screen': (lambda checker: checker.screen(screened), lambda: (EGCChecker(model, 'bigg'),)),
+        'flux_balance_analysis': (flux_balance_analysis,
+                                  lambda: (deepcopy(model), {'TARGET_EX_RXNS': targets, 'FLUX_CUTOFF': 1e-5,
+                                                     'LOOPLESS_FVA': 'cobra', 'FVA_PROCESSES': 1})),
+    }
+    size = {'num_reactions': num_reactions, 'num_candidates': num_candidates,
+            'num_metabolites': len(model.metabolites), 'nnz': int(rxn_matrix.nnz + rxn_pool_matrix.nnz)}
+    for name in settings.benchmarks.split(','):
+        if name not in benchmarks:
+            raise RuntimeError('unknown benchmark %s.' % name)
+        fn, setup = benchmarks[name]
+        seconds = measure(fn, setup, settings.repeat)
+        yield dict(benchmark=name, seconds=seconds, min=min(seconds), median=float(np.median(seconds)), **size)
+
+
+def main():
+    settings = parse()
+    sys.argv = sys.argv[:1]
+    settings.solver = solvers.choose(settings.solver)
+    from profiler import peak_rss
+    os.makedirs(os.path.dirname(settings.output) or '.', exist_ok=True)
+    info = dict(environment(), timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), degree=settings.degree,
+                mean_degree=settings.mean_degree, degree_exponent=settings.degree_exponent, hub_exponent=settings.hub_exponent,
+                metabolite_ratio=settings.metabolite_ratio, solver=settings.solver, seed=settings.seed)
+    for num_reactions in [int(n) for n in settings.num_reactions.split(',')]:
+        for result in run(num_reactions, settings):
+            result = dict(result, peak_rss_mb=peak_rss(), **info)
+            print('%-22s %6d reactions  median %.4fs' % (result['benchmark'], num_reactions, result['median']))
+            with open(settings.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == "__main__":
+    main()
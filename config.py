@@ -3,8 +3,8 @@ import argparse
 
 def parse():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--train_size', type=float, default=0.6)
-    parser.add_argument('--test_size', type=float, default=0.1)
+    parser.add_argument('--train_size', type=float, default=0.6)  # with --patience, hyperlinks are split into training
+    parser.add_argument('--test_size', type=float, default=0.1)  # and validation sets in the ratio train_size : test_size
     parser.add_argument('--emb_dim', type=int, default=256)
     parser.add_argument('--conv_dim', type=int, default=128)
     parser.add_argument('--k', type=int, default=3)
@@ -12,4 +12,16 @@ def parse():
     parser.add_argument('--max_epoch', type=int, default=30)
     parser.add_argument('--lr', type=float, default=0.01)
     parser.add_argument('--weight_decay', type=float, default=5e-4)
+    parser.add_argument('--patience', type=int, default=0)  # validations without improvement before stopping; 0 disables early stopping
+    parser.add_argument('--val_interval', type=int, default=1)  # epochs between validations
+    parser.add_argument('--resample_neg', action='store_true')  # draw fresh negative hyperlinks every epoch
+    parser.add_argument('--seed', type=int, default=None)  # seed of the first ensemble member; unseeded if omitted
+    parser.add_argument('--export_csv', action='store_true')  # also export predicted scores as csv
+    parser.add_argument('--num_workers', type=int, default=1)  # GEMs trained concurrently in worker processes
+    parser.add_argument('--num_threads', type=int, default=0)  # torch threads per worker; 0 splits the cores evenly
+    parser.add_argument('--profile_directory', type=str, default='./results/profiles')  # per-GEM timing reports
+    parser.add_argument('--trace_memory', action='store_true')  # also trace python allocations (slower)
+    parser.add_argument('--cprofile', action='store_true')  # also write a cProfile dump per GEM
+    parser.add_argument('--chunk_size', type=int, default=1024)  # candidate hyperedges scored per forward pass
+    parser.add_argument('--max_chunk_edges', type=int, default=1000000)  # clique-expansion edges per forward pass
     return parser.parse_args()
\ No newline at end of file
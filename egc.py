@@ -1,9 +1,16 @@
 from copy import deepcopy
 from cobra import Reaction
+from cobra.core.solution import get_solution
+from optlang.interface import OPTIMAL, INFEASIBLE
+from optlang.symbolics import Zero
+import pandas as pd
+from profiler import stage
 import warnings
 
 warnings.filterwarnings("ignore")
 
+SCREEN_EPSILON = 1e-3  # flux a screened reaction is asked to carry, and least dissipation flux of a screened EGC
+
 # energy couplers
 energy_couples_modelseed = {
     'cpd00002_c0': 'cpd00008_c0',
@@ -45,124 +52,306 @@ energy_couples_bigg = {
 }
 
 
-# This function identifies energy-generating cycle by maximizing flux towards a dissipation reaction
-# If rid is not none, it returns EGC with non-zero flux through rid
-def detect_egc(model, metabolite_id, rid=None, namespace='bigg'):
-    # close all boundary reactions (including exchange reactions, demand reactions and sink reactions)
-    for boundary in model.boundary:
-        boundary.bounds = (0, 0)
-
-    # get dissipation product
-    energy_couples = energy_couples_bigg
-    if namespace == 'modelseed':
-        energy_couples = energy_couples_modelseed
-    met = model.metabolites.get_by_id(metabolite_id)
-    if energy_couples[met.id] in model.metabolites:
-        dissipation_product = model.metabolites.get_by_id(energy_couples[met.id])
-    else:
-        return None
-
-    # add a demand reaction
-    dissipation_rxn = Reaction('Dissipation')
-    model.add_reactions([dissipation_rxn])
+# reaction string of the dissipation reaction of an energy couple, besides the couple itself
+def dissipation_reaction_string(metabolite_id, namespace='bigg'):
     if namespace == 'bigg':
-        if met.id in ['atp_c', 'ctp_c', 'gtp_c', 'utp_c', 'itp_c']:
+        if metabolite_id in ['atp_c', 'ctp_c', 'gtp_c', 'utp_c', 'itp_c']:
             # build nucleotide-type dissipation reaction
-            dissipation_rxn.reaction = "h2o_c --> h_c + pi_c"
-        elif met.id in ['nadph_c', 'nadh_c']:
+            return "h2o_c --> h_c + pi_c"
+        elif metabolite_id in ['nadph_c', 'nadh_c']:
             # build nicotinamide-type dissipation reaction
-            dissipation_rxn.reaction = "--> h_c"
-        elif met.id in ['fadh2_c', 'fmnh2_c', 'q8h2_c', 'mql8_c',
-                        'mql6_c', 'mql7_c', 'dmmql8_c']:
+            return "--> h_c"
+        elif metabolite_id in ['fadh2_c', 'fmnh2_c', 'q8h2_c', 'mql8_c',
+                               'mql6_c', 'mql7_c', 'dmmql8_c']:
             # build redox-partner-type dissipation reaction
-            dissipation_rxn.reaction = "--> 2 h_c"
-        elif met.id == 'accoa_c':
-            dissipation_rxn.reaction = "h2o_c --> h_c + ac_c"
-        elif met.id == "glu__L_c":
-            dissipation_rxn.reaction = "h2o_c --> 2 h_c + nh3_c"
-        elif met.id == 'h_p':
-            pass
+            return "--> 2 h_c"
+        elif metabolite_id == 'accoa_c':
+            return "h2o_c --> h_c + ac_c"
+        elif metabolite_id == "glu__L_c":
+            return "h2o_c --> 2 h_c + nh3_c"
     elif namespace == 'modelseed':
-        if met.id in ['cpd00002_c0', 'cpd00052_c0', 'cpd00038_c0', 'cpd00062_c0', 'cpd00068_c0']:
+        if metabolite_id in ['cpd00002_c0', 'cpd00052_c0', 'cpd00038_c0', 'cpd00062_c0', 'cpd00068_c0']:
             # build nucleotide-type dissipation reaction
-            dissipation_rxn.reaction = "cpd00001_c0 --> cpd00067_c0 + cpd00009_c0"
-        elif met.id in ['cpd00005_c0', 'cpd00004_c0']:
+            return "cpd00001_c0 --> cpd00067_c0 + cpd00009_c0"
+        elif metabolite_id in ['cpd00005_c0', 'cpd00004_c0']:
             # build nicotinamide-type dissipation reaction
-            dissipation_rxn.reaction = "--> cpd00067_c0"
-        elif met.id in ['cpd00982_c0', 'cpd01270_c0', 'cpd15561_c0', 'cpd15499_c0',
-                        'cpd15994_c0', 'cpd23255_c0', 'cpd15353_c0']:
+            return "--> cpd00067_c0"
+        elif metabolite_id in ['cpd00982_c0', 'cpd01270_c0', 'cpd15561_c0', 'cpd15499_c0',
+                               'cpd15994_c0', 'cpd23255_c0', 'cpd15353_c0']:
             # build redox-partner-type dissipation reaction
-            dissipation_rxn.reaction = "--> 2 cpd00067_c0"
-        elif met.id == 'cpd00022_c0':
-            dissipation_rxn.reaction = "cpd00001_c0 --> cpd00067_c0 +  cpd00029_c0"
-        elif met.id == 'cpd00023_c0':
-            dissipation_rxn.reaction = "cpd00001_c0 --> 2 cpd00067_c0 +  cpd00013_c0"
-        elif met.id == 'cpd00067_p0':
-            pass
-    dissipation_rxn.add_metabolites(
-        {met.id: -1, dissipation_product: 1})
-    model.objective = dissipation_rxn
-
-    # it is possible that an EGC solution has zero flux through the target reaction
-    # to check if a target reaction mediates formation of EGC, force fluxes through this reaction
-    if rid is None:
-        solution = model.optimize()
-    else:
-        # find EGC when forcing flux through the target reaction
-        original_bounds = model.reactions.get_by_id(rid).bounds
-        solution_w_enforced_flux_found = False
-        for enforced_flux in ['negative', 'positive']:
-            if enforced_flux == 'negative':
-                if original_bounds[0] <= -0.01:
-                    model.reactions.get_by_id(rid).bounds = [-1000.0, -0.01]
-            if enforced_flux == 'positive:':
-                if original_bounds[1] >= 0.01:
-                    model.reactions.get_by_id(rid).bounds = [0.01, 1000.0]
-            solution = model.optimize()
-            if solution.status == "optimal":
-                solution_w_enforced_flux_found = True
-            else:
-                model.reactions.get_by_id(rid).bounds = original_bounds
-        if not solution_w_enforced_flux_found:
-            solution = model.optimize()
-
-    # return results
-    if solution.status == 'infeasible':
-        raise RuntimeError(
-            "The model cannot be solved as the solver status is"
-            "infeasible. This may be a bug."
-        )
-    elif solution.objective_value > 0.0:
-        return solution.fluxes[solution.fluxes.abs() > 0.0].to_frame().drop(["Dissipation"])
-    else:
-        return None
-
-
-# This function detects and resolves EGC formed when adding reaction rid
-def resolve_egc(model, rid, namespace):
-    energy_couples = energy_couples_bigg
-    if namespace == "modelseed":
-        energy_couples = energy_couples_modelseed
-    for key_met in energy_couples.keys():
-        if key_met in model.metabolites:  # energy couple is part of the model
-            df_sol = detect_egc(deepcopy(model), key_met, rid, namespace)
-            if df_sol is not None and rid in list(df_sol.index):  # EGC found and involves reaction rid
-                rxn = model.reactions.get_by_id(rid)
-
-                # The principle for resolving EGC:
-                # 1. If the reaction is irreversible, then we cannot add this reaction. Skip this reaction.
-                # 2. If the reaction is reversible, turn it to irreversible and detect EGC again.
-                # 3. If EGC remains, then we have to skip this reaction
-                if rxn.lower_bound == 0.0 or rxn.upper_bound == 0.0:  # irreversible
-                    return False
+            return "--> 2 cpd00067_c0"
+        elif metabolite_id == 'cpd00022_c0':
+            return "cpd00001_c0 --> cpd00067_c0 +  cpd00029_c0"
+        elif metabolite_id == 'cpd00023_c0':
+            return "cpd00001_c0 --> 2 cpd00067_c0 +  cpd00013_c0"
+    return None
+
+
+def get_energy_couples(namespace):
+    if namespace == 'modelseed':
+        return energy_couples_modelseed
+    return energy_couples_bigg
+
+
+# Energy-generating cycle (EGC) detection on one copy of a model, kept for all energy couples and all
+# candidate reactions: boundaries are closed once, and the dissipation reaction of each energy couple is
+# created once (when both of its metabolites are in the model) with zero bounds. A check opens one
+# dissipation reaction and maximizes its flux, so the solver reuses its previous basis. Candidate
+# reactions are added in place with add(), inside a `with checker.model:` block to try them out.
+class EGCChecker:
+    def __init__(self, model, namespace='bigg'):
+        self.namespace = namespace
+        self.energy_couples = get_energy_couples(namespace)
+        self.model = deepcopy(model)
+        # close all boundary reactions (including exchange reactions, demand reactions and sink reactions)
+        for boundary in self.model.boundary:
+            boundary.bounds = (0, 0)
+        self.open_bounds = {}
+        for metabolite_id in self.energy_couples:
+            self.dissipation(metabolite_id)
+
+    # add reactions to the checked model; boundary reactions stay closed as in the rest of the model
+    def add(self, reactions):
+        reactions = [rxn.copy() for rxn in reactions]
+        self.model.add_reactions(reactions)
+        for rxn in reactions:
+            if rxn.boundary:
+                rxn.bounds = (0, 0)
+
+    # the (closed) dissipation reaction of an energy couple, created on first use; None if either metabolite
+    # of the couple is missing from the model
+    def dissipation(self, metabolite_id):
+        rid = 'Dissipation_' + metabolite_id
+        if rid in self.model.reactions:
+            return self.model.reactions.get_by_id(rid)
+        product_id = self.energy_couples[metabolite_id]
+        if metabolite_id not in self.model.metabolites or product_id not in self.model.metabolites:
+            return None
+        dissipation_rxn = Reaction(rid)
+        self.model.add_reactions([dissipation_rxn])
+        reaction_string = dissipation_reaction_string(metabolite_id, self.namespace)
+        if reaction_string is not None:
+            dissipation_rxn.reaction = reaction_string
+        dissipation_rxn.add_metabolites({metabolite_id: -1, self.model.metabolites.get_by_id(product_id): 1})
+        self.open_bounds[rid] = dissipation_rxn.bounds
+        dissipation_rxn.bounds = (0, 0)
+        return dissipation_rxn
+
+    # This function identifies energy-generating cycle by maximizing flux towards a dissipation reaction
+    # If rid is not none, it returns EGC with non-zero flux through rid
+    def detect(self, metabolite_id, rid=None):
+        if metabolite_id not in self.model.metabolites:
+            return None
+        dissipation_rxn = self.dissipation(metabolite_id)
+        if dissipation_rxn is None:
+            return None
+        dissipation_rxn.bounds = self.open_bounds[dissipation_rxn.id]
+        self.model.objective = dissipation_rxn
+        rxn = None if rid is None else self.model.reactions.get_by_id(rid)
+        original_bounds = None if rxn is None else rxn.bounds
+        try:
+            # it is possible that an EGC solution has zero flux through the target reaction
+            # to check if a target reaction mediates formation of EGC, force fluxes through this reaction.
+            # Only negative fluxes are ever forced: the positive case was never reached, as its check
+            # compared against 'positive:'
+            solved = False
+            if rxn is not None and original_bounds[0] <= -0.01:
+                rxn.bounds = (-1000.0, -0.01)
+                objective_value = self.model.slim_optimize()
+                if self.model.solver.status == OPTIMAL:
+                    solved = True
                 else:
-                    rid_flux = df_sol.loc[rid, 'fluxes']  # flux through the reaction rid
-                    if rid_flux > 0:
-                        rxn.upper_bound = float(0.0)
-                    else:
-                        rxn.lower_bound = float(0.0)
-                    df_sol = detect_egc(deepcopy(model), key_met, rid, namespace)
-                    if df_sol is not None:  # EGC remains
+                    rxn.bounds = original_bounds
+            if not solved:
+                objective_value = self.model.slim_optimize()
+
+            # return results
+            if self.model.solver.status == INFEASIBLE:
+                raise RuntimeError(
+                    "The model cannot be solved as the solver status is"
+                    "infeasible. This may be a bug."
+                )
+            elif objective_value > 0.0:
+                fluxes = get_solution(self.model, reactions=self.model.reactions).fluxes
+                return fluxes[fluxes.abs() > 0.0].to_frame().drop([dissipation_rxn.id])
+            else:
+                return None
+        finally:
+            if rxn is not None:
+                rxn.bounds = original_bounds
+            dissipation_rxn.bounds = (0, 0)
+
+    # This function detects and resolves EGC formed when adding reaction rid; the reaction may be made
+    # irreversible on the way, also when it cannot be resolved
+    @stage('egc_check')
+    def resolve(self, rid):
+        for key_met in self.energy_couples.keys():
+            if key_met in self.model.metabolites:  # energy couple is part of the model
+                df_sol = self.detect(key_met, rid)
+                if df_sol is not None and rid in list(df_sol.index):  # EGC found and involves reaction rid
+                    rxn = self.model.reactions.get_by_id(rid)
+
+                    # The principle for resolving EGC:
+                    # 1. If the reaction is irreversible, then we cannot add this reaction. Skip this reaction.
+                    # 2. If the reaction is reversible, turn it to irreversible and detect EGC again.
+                    # 3. If EGC remains, then we have to skip this reaction
+                    if rxn.lower_bound == 0.0 or rxn.upper_bound == 0.0:  # irreversible
                         return False
+                    else:
+                        rid_flux = df_sol.loc[rid, 'fluxes']  # flux through the reaction rid
+                        if rid_flux > 0:
+                            rxn.upper_bound = float(0.0)
+                        else:
+                            rxn.lower_bound = float(0.0)
+                        df_sol = self.detect(key_met, rid)
+                        if df_sol is not None:  # EGC remains
+                            return False
+
+        return True
+
+    # which of the given reactions can carry flux (in either direction) in a steady state of the model that
+    # dissipates each energy couple, i.e. in an EGC or together with one; a DataFrame of booleans, reactions x
+    # energy couples. The reactions are screened all added together: an EGC of the model with some of them added
+    # is also one of the model with all of them, so resolve() leaves a reaction that is not flagged unchanged. As in
+    # detect(), any nonzero flux counts, so a flux at the level of solver noise flags a reaction rather than hides it.
+    @stage('egc_screen')
+    def screen(self, reactions):
+        rids = [rxn.id for rxn in reactions]
+        flagged = pd.DataFrame(False, index=rids, columns=list(self.energy_couples.keys()))
+        with self.model:
+            self.add([rxn for rxn in reactions if rxn.id not in self.model.reactions])
+            for metabolite_id in self.energy_couples:
+                if metabolite_id not in self.model.metabolites:
+                    continue
+                dissipation_rxn = self.dissipation(metabolite_id)
+                if dissipation_rxn is None:
+                    continue
+                dissipation_rxn.bounds = self.open_bounds[dissipation_rxn.id]
+                self.model.objective = dissipation_rxn
+                max_dissipation = self.model.slim_optimize(error_value=0.0)
+                if max_dissipation > 0.0:
+                    dissipation_rxn.lower_bound = min(SCREEN_EPSILON, max_dissipation / 2)
+                    flagged.loc[self.carrying_flux(rids), metabolite_id] = True
+                dissipation_rxn.bounds = (0, 0)
+        return flagged[[met for met in flagged.columns if met in self.model.metabolites]]
+
+    # reactions among rids that can carry flux under the current bounds, as in FASTCORE: reactions blocked by a dead
+    # end are left out, the irreversible ones are found together (see flag_directions), then the reversible ones in
+    # their forward direction, then those left in their reverse direction. A reversible reaction held to one
+    # direction can keep another from carrying flux, so the few reversible ones still left are maximized and
+    # minimized one by one.
+    def carrying_flux(self, rids, tolerance=0.0):
+        flagged = set()
+        blocked = self.dead_ends()
+        irreversible, reversible = {}, []
+        for rid in rids:
+            rxn = self.model.reactions.get_by_id(rid)
+            if rid in blocked:
+                continue
+            elif rxn.lower_bound < 0 < rxn.upper_bound:
+                reversible.append(rid)
+            elif rxn.upper_bound > 0 or rxn.lower_bound < 0:
+                irreversible[rid] = 1 if rxn.upper_bound > 0 else -1
+        self.flag_directions(rids, irreversible, flagged, tolerance)
+        for direction in [1, -1]:
+            self.flag_directions(rids, {rid: direction for rid in reversible if rid not in flagged}, flagged, tolerance)
+
+        for rid in reversible:
+            if rid in flagged:
+                continue
+            self.model.objective = self.model.reactions.get_by_id(rid)
+            for direction in ['max', 'min']:
+                self.model.objective_direction = direction
+                if abs(self.model.slim_optimize(error_value=0.0)) > tolerance:
+                    self.flag_fluxes(rids, flagged, tolerance)
+                    flagged.add(rid)
+                    break
+        self.model.objective_direction = 'max'
+        return [rid for rid in rids if rid in flagged]
+
+    # add to flagged the reactions of directions ({reaction id: 1 or -1}) that can carry flux in their direction:
+    # each LP maximizes their flux in that direction, each capped at SCREEN_EPSILON, and those carrying flux are
+    # dropped from the objective and freed of their direction, until the LP finds none. Any reaction of rids
+    # carrying flux in one of these solutions is flagged as well.
+    def flag_directions(self, rids, directions, flagged, tolerance):
+        if len(directions) == 0:
+            return
+        with self.model:
+            problem = self.model.problem
+            indicators = {rid: problem.Variable('screen_' + rid, lb=0, ub=SCREEN_EPSILON) for rid in directions}
+            constraints = {rid: problem.Constraint(Zero, name='screen_flux_' + rid, ub=0) for rid in directions}
+            self.model.add_cons_vars(list(indicators.values()) + list(constraints.values()), sloppy=True)
+            self.model.solver.update()
+            for rid, direction in directions.items():
+                rxn = self.model.reactions.get_by_id(rid)
+                # indicator <= flux in the given direction
+                constraints[rid].set_linear_coefficients({indicators[rid]: 1, rxn.forward_variable: -direction,
+                                                          rxn.reverse_variable: direction})
+            self.model.objective = problem.Objective(Zero, direction='max', sloppy=True)
+            self.model.objective.set_linear_coefficients({indicator: 1 for indicator in indicators.values()})
+            while len(indicators) > 0:
+                value = self.model.slim_optimize(error_value=0.0)
+                if value <= tolerance:
+                    break
+                self.flag_fluxes(rids, flagged, tolerance)
+                # the largest indicators hold at least the average, so every LP drops one reaction
+                primals = self.model.solver.primal_values
+                flagged.update(rid for rid, indicator in indicators.items()
+                               if primals[indicator.name] >= value / len(indicators))
+                dropped = [rid for rid in indicators if rid in flagged]
+                self.model.objective.set_linear_coefficients({indicators.pop(rid): 0 for rid in dropped})
+                for rid in dropped:
+                    constraints[rid].ub = None
 
-    return True
+    # reactions that carry no flux in any steady state under the current bounds because one of their metabolites
+    # can only be produced, only be consumed or takes part in no other reaction, once such reactions are removed
+    def dead_ends(self):
+        producers, consumers = {}, {}
+        for rxn in self.model.reactions:
+            for met, coefficient in rxn.metabolites.items():
+                producers.setdefault(met.id, set())
+                consumers.setdefault(met.id, set())
+                if coefficient > 0 and rxn.upper_bound > 0 or coefficient < 0 and rxn.lower_bound < 0:
+                    producers[met.id].add(rxn.id)
+                if coefficient < 0 and rxn.upper_bound > 0 or coefficient > 0 and rxn.lower_bound < 0:
+                    consumers[met.id].add(rxn.id)
+        blocked = set()
+        queue = list(producers)
+        while len(queue) > 0:
+            met_id = queue.pop()
+            rids = producers[met_id] | consumers[met_id]
+            if len(rids) == 0 or len(producers[met_id]) > 0 and len(consumers[met_id]) > 0 and len(rids) > 1:
+                continue
+            for rid in rids:
+                blocked.add(rid)
+                for met in self.model.reactions.get_by_id(rid).metabolites:
+                    producers[met.id].discard(rid)
+                    consumers[met.id].discard(rid)
+                    queue.append(met.id)
+        return blocked
+
+    # add to flagged the reactions of rids carrying flux in the current solution; the primal values are read at
+    # once, as reading them reaction by reaction syncs the solver every time
+    def flag_fluxes(self, rids, flagged, tolerance):
+        primals = self.model.solver.primal_values
+        for rid in rids:
+            if rid in flagged:
+                continue
+            rxn = self.model.reactions.get_by_id(rid)
+            if abs(primals[rxn.forward_variable.name] - primals[rxn.reverse_variable.name]) > tolerance:
+                flagged.add(rid)
+
+
+# This function identifies energy-generating cycle by maximizing flux towards a dissipation reaction
+# If rid is not none, it returns EGC with non-zero flux through rid
+def detect_egc(model, metabolite_id, rid=None, namespace='bigg'):
+    return EGCChecker(model, namespace).detect(metabolite_id, rid)
+
+
+# This function detects and resolves EGC formed when adding reaction rid. Checking many reactions against
+# the same model is cheaper with one EGCChecker.
+def resolve_egc(model, rid, namespace):
+    checker = EGCChecker(model, namespace)
+    egc_resolved = checker.resolve(rid)
+    model.reactions.get_by_id(rid).bounds = checker.model.reactions.get_by_id(rid).bounds
+    return egc_resolved
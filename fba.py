@@ -3,29 +3,45 @@ from cobra.flux_analysis import flux_variability_analysis
 from optlang.interface import OPTIMAL
 import pandas as pd
 import numpy as np
-from gapfilling import add_gapfilled_reactions
-from optlang.symbolics import add
+from joblib import Parallel, delayed
+from gapfilling import load_model, draw_seeds, select_candidates, fill_gaps
+from optlang.symbolics import Zero
 from copy import deepcopy
+import profiler
+import solvers
+from profiler import stage
+
+LOOPLESS_FVA = ['cobra', 'none']
+
+
+# flux variability of rxn_ids within fraction_of_optimum of the objective, by cobra's FVA: the optimality constraint
+# is added once, all minima and maxima are solved on one solver and, with processes > 1, the reactions are split
+# across worker processes. Loops are removed as in cobra's loopless FVA (loopless='cobra') or not at all ('none').
+# Boundary reactions cannot be part of a loop, so they are always solved without loop removal; this spares them
+# the search for cyclic reactions over the whole model that newer cobra versions run before a loopless FVA.
+def flux_variability(model, rxn_ids, fraction_of_optimum=1.0, loopless='cobra', processes=1):
+    if loopless not in LOOPLESS_FVA:
+        raise RuntimeError('unknown loopless FVA method %s.' % loopless)
+    boundary = [rid for rid in rxn_ids if model.reactions.get_by_id(rid).boundary]
+    internal = [rid for rid in rxn_ids if not model.reactions.get_by_id(rid).boundary]
+    fva = [flux_variability_analysis(model, rids, loopless=remove_loops, fraction_of_optimum=fraction_of_optimum,
+                                     processes=int(processes))
+           for rids, remove_loops in [(boundary, False), (internal, loopless == 'cobra')] if len(rids) > 0]
+    return pd.concat(fva).loc[list(rxn_ids)]
 
 
 def flux_balance_analysis(model, paras):
     # run flux balance analysis
-    # try different linear programming method the default algorithm fails
-    fba_solution = model.optimize()
-    if model.solver.status != OPTIMAL:
-        is_optimal = False
-        for lp_method in ["primal", "dual", "network", "barrier", "sifting", "concurrent"]:
-            model.solver.configuration.lp_method = lp_method
-            fba_solution = model.optimize()
-            if model.solver.status == OPTIMAL:
-                is_optimal = True
-                break
-        assert is_optimal
-    assert fba_solution.objective_value > 0.0
+    # try the fallback settings of the solver if the default ones fail
+    with stage('fba'):
+        fba_solution = solvers.optimize(model)
+        assert model.solver.status == OPTIMAL
+        assert fba_solution.objective_value > 0.0
 
     # run parsimonious flux balance analysis
     # try different linear programming method the default algorithm fails
-    pfba_solution = cobra.flux_analysis.pfba(model)
+    with stage('pfba'):
+        pfba_solution = cobra.flux_analysis.pfba(model)
 
     # modify flux bounds to minimize input fluxes that do not contribute to growth
     # For flux > 0, set its lower bound to 0
@@ -38,12 +54,14 @@ def flux_balance_analysis(model, paras):
             ex.lower_bound = pfba_solution.fluxes[ex.id]
 
     # run flux variability analysis
-    fva = flux_variability_analysis(
-        model,
-        paras['TARGET_EX_RXNS'],
-        fraction_of_optimum=0.999999,
-        loopless=True
-    )
+    with stage('fva'):
+        fva = flux_variability(
+            model,
+            paras['TARGET_EX_RXNS'],
+            fraction_of_optimum=0.999999,
+            loopless=paras['LOOPLESS_FVA'],
+            processes=paras['FVA_PROCESSES']
+        )
     fva.index.name = 'reaction'
     fva = fva.reset_index()
     fva['biomass'] = fba_solution.objective_value
@@ -52,14 +70,116 @@ def flux_balance_analysis(model, paras):
     return fva
 
 
+# minimal sets of gap-filled reactions that let an exchange reaction secrete: the number of indicator variables
+# is minimized, with -1000 * indicator <= flux <= 1000 * indicator for every gap-filled reaction. The MILP is
+# built once per gap-filled model; a query only sets the lower bound of its exchange reaction, so the solver
+# keeps its state (and, with cplex, starts from the indicators of the previous query) between queries.
+class KeyReactionFinder:
+    def __init__(self, model, rids):
+        self.model = deepcopy(model)
+        self.rids = list(rids)
+        self.previous = None
+        problem = self.model.problem
+        self.indicators = [problem.Variable('indicator_var_' + rid, lb=0, ub=1, type='binary') for rid in self.rids]
+        lower = [problem.Constraint(Zero, name='constr1' + rid, lb=0) for rid in self.rids]
+        upper = [problem.Constraint(Zero, name='constr2' + rid, ub=0) for rid in self.rids]
+        self.model.add_cons_vars(self.indicators + lower + upper, sloppy=True)
+        self.model.solver.update()
+        for rid, var, con1, con2 in zip(self.rids, self.indicators, lower, upper):
+            rxn = self.model.reactions.get_by_id(rid)
+            con1.set_linear_coefficients({rxn.forward_variable: 1, rxn.reverse_variable: -1, var: 1000.0})
+            con2.set_linear_coefficients({rxn.forward_variable: 1, rxn.reverse_variable: -1, var: -1000.0})
+        self.model.objective = problem.Objective(Zero, direction='min', sloppy=True)
+        self.model.objective.set_linear_coefficients({var: 1 for var in self.indicators})
+
+    # gap-filled reactions needed for a flux of at least min_flux through exchange reaction ex, or None if the MILP
+    # cannot be solved at any integrality tolerance
+    def find(self, ex, min_flux=0.1):
+        with self.model:
+            self.model.reactions.get_by_id(ex).lower_bound = min_flux  # some nontrivial small number
+            self.mip_start()
+            solved = False
+            for tol in solvers.integrality_tolerances(self.model):
+                self.model.solver.configuration.tolerances.integrality = tol
+                try:
+                    self.model.slim_optimize()
+                except Exception:
+                    continue
+                if self.model.solver.status == OPTIMAL:
+                    solved = True
+                    break
+            if not solved:
+                return None
+            self.previous = [var.primal for var in self.indicators]
+            return [rid for rid, var in zip(self.rids, self.indicators) if var.primal > 0.5]
+
+    def mip_start(self):
+        if self.previous is None or self.model.solver.interface.__name__ != 'optlang.cplex_interface':
+            return
+        import cplex
+        problem = self.model.solver.problem
+        problem.MIP_starts.delete()
+        problem.MIP_starts.add(cplex.SparsePair(ind=[var.name for var in self.indicators], val=self.previous),
+                               problem.MIP_starts.effort_level.repair)
+
+
+# key reactions of each exchange reaction in exchanges, as {exchange: reaction ids or None}; with processes > 1
+# the exchanges are split across worker processes, each building its own MILP
+def find_key_reactions(model, rids, exchanges, processes=1):
+    processes = min(processes, len(exchanges))
+    if processes > 1:
+        results = Parallel(n_jobs=processes)(
+            delayed(find_key_reactions)(model, rids, list(chunk)) for chunk in np.array_split(exchanges, processes)
+        )
+        return {ex: key for result in results for ex, key in result.items()}
+
+    key_rxns = {}
+    if len(exchanges) > 0:
+        finder = KeyReactionFinder(model, rids)
+        for ex in exchanges:
+            with stage('key_reaction_milp', reaction=ex):
+                key_rxns[ex] = finder.find(ex)
+    return key_rxns
+
+
+# runs in a joblib worker, so the profiler is configured here rather than by the caller
 def predict_fermentation(gem_file, universe, paras):
+    profiler.configure(paras['PROFILE_DIRECTORY'], int(paras['TRACE_MEMORY']), int(paras['CPROFILE']))
+    with profiler.session(gem_file, 'validate'):
+        return _predict_fermentation(gem_file, universe, paras)
+
+
+def _predict_fermentation(gem_file, universe, paras):
     print('predicting fermentation: %s...' % gem_file)
-    # read model and add missing reactions
-    model_no_gapfill, model_w_gapfill, num_rxns_added, rids_added = add_gapfilled_reactions(gem_file, universe, paras)
+    # read model
+    with stage('gapfilling'):
+        model, max_growth = load_model(gem_file, universe, paras)
 
-    # run flux balance analysis for model with and without gap filling
-    fva_no_gapfill = flux_balance_analysis(model_no_gapfill, paras)
+    # run flux balance analysis for model without gap filling, once for all draws
+    fva_no_gapfill = flux_balance_analysis(deepcopy(model), paras)
     fva_no_gapfill.columns = [c + '__no_gapfill' if c != 'reaction' else 'reaction' for c in fva_no_gapfill.columns]
+
+    # with ADD_RANDOM_RXNS, NUM_RANDOM_DRAWS random draws of reactions are added to the same loaded model, which is
+    # restored after each draw; otherwise the predicted reactions are added once
+    seeds = draw_seeds(paras) if int(paras['ADD_RANDOM_RXNS']) else [None]
+    results = []
+    for draw, seed in enumerate(seeds):
+        with model:
+            with stage('gapfilling', draw=draw):
+                candidates = select_candidates(gem_file, model, universe, paras, seed)
+                num_rxns_added, rids_added = fill_gaps(gem_file, model, max_growth, candidates, universe, paras)
+            fva = compare_phenotypes(gem_file, fva_no_gapfill, model, num_rxns_added, rids_added, paras)
+        if seed is not None:
+            fva['draw'] = draw
+            fva['random_seed'] = seed
+        results.append(fva)
+    return pd.concat(results, ignore_index=True)
+
+
+# phenotypes of the gap-filled model next to those of the model without gap filling, with the gap-filled
+# reactions that enable each new fermentation product
+def compare_phenotypes(gem_file, fva_no_gapfill, model_w_gapfill, num_rxns_added, rids_added, paras):
+    # run flux balance analysis for model with gap filling
     fva_w_gapfill = flux_balance_analysis(model_w_gapfill, paras)
     fva_w_gapfill.columns = [c + '__w_gapfill' if c != 'reaction' else 'reaction' for c in fva_w_gapfill.columns]
     fva = pd.merge(fva_no_gapfill, fva_w_gapfill, left_on='reaction', right_on='reaction', how='inner')
@@ -72,58 +192,13 @@ def predict_fermentation(gem_file, universe, paras):
     fva['rxn_ids_added'] = ';'.join(rids_added)
 
     # find reactions that lead to phenotypic changes from 0 to 1
-    key_rxns = []
-    for ex, phe1, phe2 in zip(fva['reaction'], fva['phenotype__no_gapfill'], fva['phenotype__w_gapfill']):
-        if phe1 == 0 and phe2 == 1:
-            model_w_gapfill2 = deepcopy(model_w_gapfill)
-            model_w_gapfill2.reactions.get_by_id(ex).lower_bound = 0.1  # some nontrivial small number
-            indicator_vars = []
-            for rid in rids_added:
-                var = model_w_gapfill2.problem.Variable('indicator_var_' + rid, lb=0, ub=1, type='binary')
-                indicator_vars.append(var)
-                con1 = model_w_gapfill2.problem.Constraint(
-                    (model_w_gapfill2.reactions.get_by_id(rid).flux_expression + 1000.0 * var).expand(),
-                    name='constr1' + rid,
-                    lb=0
-                )
-                con2 = model_w_gapfill2.problem.Constraint(
-                    (model_w_gapfill2.reactions.get_by_id(rid).flux_expression - 1000.0 * var).expand(),
-                    name='constr2' + rid,
-                    ub=0
-                )
-                model_w_gapfill2.add_cons_vars([var, con1, con2])
-                model_w_gapfill2.solver.update()
-
-            model_w_gapfill2.objective = add(*indicator_vars)
-            model_w_gapfill2.objective.direction = "min"
-            model_w_gapfill2.solver.update()
-
-            skip_this_prediction = False
-            for tol in [1e-9, 1e-8, 1e-7, 1e-6]:
-                model_w_gapfill2.solver.problem.parameters.mip.tolerances.integrality.set(tol)
-                try:
-                    sol = model_w_gapfill2.optimize()
-                    break
-                except:
-                    if tol == 1e-6:
-                        skip_this_prediction = True
-            if skip_this_prediction:
-                key_rxns.append(np.NaN)
-            else:
-                if sol.objective_value >= 1:
-                    key_rxns2 = []
-                    for var in model_w_gapfill2.variables:
-                        rid = var.name.lstrip('indicator_var_')
-                        if var.primal == 1:
-                            print(ex, var.name)
-                        if var.primal == 1 and rid in rids_added:
-                            key_rxns2.append(rid)
-                    key_rxns.append(';'.join(key_rxns2))
-                    print('predict_fermentation: %s can be gapfilled by %s' % (ex, key_rxns[-1]))
-                else:
-                    key_rxns.append(np.NaN)
-        else:
-            key_rxns.append(np.NaN)
+    flipped = [ex for ex, phe1, phe2 in zip(fva['reaction'], fva['phenotype__no_gapfill'], fva['phenotype__w_gapfill'])
+               if phe1 == 0 and phe2 == 1]
+    key_rxns = find_key_reactions(model_w_gapfill, rids_added, flipped, int(paras['KEY_RXN_PROCESSES']))
+    for ex in flipped:
+        if key_rxns[ex] is not None and len(key_rxns[ex]) > 0:
+            print('predict_fermentation: %s can be gapfilled by %s' % (ex, ';'.join(key_rxns[ex])))
+    key_rxns = [';'.join(key_rxns[ex]) if key_rxns.get(ex) else np.NaN for ex in fva['reaction']]
     fva['essential_rxns'] = key_rxns
 
     return fva
@@ -1,8 +1,10 @@
 import cobra
-from copy import deepcopy
 import numpy as np
 import pandas as pd
-from egc import resolve_egc
+from egc import EGCChecker
+from scores import read_table
+from profiler import stage
+import solvers
 import random
 
 
@@ -39,31 +41,85 @@ def constrain_media(model, df_cm, namespace, rxn_suffix):
     return None
 
 
-# test if adding reactions will increase growth rate
-def test_growth_inflation(model, rxns_to_add):
-    max_growth = model.slim_optimize()
-    model2 = deepcopy(model)
-    model2.add_reactions(rxns_to_add)
-    max_growth2 = model2.slim_optimize()
+# maximum growth rate after adding reactions; the model is edited in place and restored when the
+# context exits, so its solver keeps its state (and warm start) instead of being copied
+@stage('growth_inflation')
+def growth_with(model, rxns_to_add):
+    with model:
+        model.add_reactions([rxn.copy() for rxn in rxns_to_add])
+        return model.slim_optimize()
+
+
+# test if adding reactions will increase growth rate; pass max_growth to reuse a known baseline
+def test_growth_inflation(model, rxns_to_add, max_growth=None):
+    if max_growth is None:
+        max_growth = model.slim_optimize()
+    max_growth2 = growth_with(model, rxns_to_add)
     if np.abs(max_growth2 - max_growth) <= 1e-6:
         return 0
     else:
         return 1
 
 
-# add reactions predicted from deep learning model or randomly selected from reaction pools
-def add_gapfilled_reactions(gem_file, universe, paras):
-    # read parameters
+# index of the first reaction that inflates the growth rate when the reactions are added one by one.
+# Adding reactions never lowers the maximum growth rate, so every prefix from that reaction on inflates
+# and bisection finds it in about log2(len(rxns)) solves. rxns as a whole must inflate the growth rate.
+# Also returns the growth rate with the reactions before it.
+def first_inflating(model, rxns, max_growth):
+    low, high = 0, len(rxns) - 1
+    growth = max_growth
+    while low < high:
+        middle = (low + high) // 2
+        growth_middle = growth_with(model, rxns[:middle + 1])
+        if np.abs(growth_middle - max_growth) > 1e-6:
+            high = middle
+        else:
+            low, growth = middle + 1, growth_middle
+    return low, growth
+
+
+# add a reaction that inflates the growth rate unless it forms an unresolvable energy-generating cycle.
+# Resolving may make the reaction irreversible; the bounds it leaves are kept. The egc checker holds the
+# reactions of the model and gets the reaction too if it is added. Returns the new growth rate, or None
+# if the reaction is not added. Reactions screened out by EGCChecker.screen() cannot form an egc and are
+# not checked (check=False).
+def add_resolving_egc(model, rxn, checker, check=True):
+    egc_resolved, bounds = True, rxn.bounds
+    if check:
+        with checker.model:
+            checker.add([rxn])
+            egc_resolved = checker.resolve(rxn.id)
+            bounds = checker.model.reactions.get_by_id(rxn.id).bounds
+    if not egc_resolved:
+        return None
+    rxn = rxn.copy()
+    rxn.bounds = bounds
+    with model:
+        model.add_reactions([rxn.copy()])
+        growth = model.slim_optimize()
+    if growth >= 2.81:
+        return None
+    model.add_reactions([rxn])
+    checker.add([rxn])
+    return growth
+
+
+# batch size for the observed share of inflating reactions p: a batch of b reactions costs one solve plus
+# about log2(b) per inflating reaction, i.e. 1 / b + p * log2(b) solves per reaction, least at b = 1 / (p ln 2)
+def adapt_batch_size(num_tested, num_inflating, max_batch_size):
+    rate = (num_inflating + 1) / (num_tested + 2)
+    return int(np.clip(round(1 / (rate * np.log(2))), 1, max_batch_size))
+
+
+# read a GEM, add the exchange reactions of the target products and constrain it by the culture medium; returns
+# the model and its maximum growth rate
+def load_model(gem_file, universe, paras):
     namespace = paras['NAMESPACE']
-    batch_size = int(paras['BATCH_SIZE'])
-    num_rxns_to_fill = int(paras['NUM_GAPFILLED_RXNS_TO_ADD'])
-    add_random_rxns = int(paras['ADD_RANDOM_RXNS'])
-    target_ex_rxns = paras['TARGET_EX_RXNS']
-    ex_suffix = paras['EX_SUFFIX']
 
     # read GEM into cobrapy
-    model = cobra.io.read_sbml_model("%s/%s.xml" % (paras['GEM_DIRECTORY'], gem_file))
-    model.solver = 'cplex'
+    with stage('load_sbml'):
+        model = cobra.io.read_sbml_model("%s/%s.xml" % (paras['GEM_DIRECTORY'], gem_file))
+    solvers.configure(model, paras['SOLVER'])
     print('add_gapfilled_reaction: model %s loaded' % gem_file)
 
     # read culture medium
@@ -72,10 +128,10 @@ def add_gapfilled_reactions(gem_file, universe, paras):
         raise RuntimeError('cannot find %s as a column of media file.' % namespace)
 
     # add exchange reactions
-    add_ex_reactions(model, universe, target_ex_rxns)
+    add_ex_reactions(model, universe, paras['TARGET_EX_RXNS'])
 
     # constrain boundary reactions by culture media
-    constrain_media(model, df_cm, namespace, ex_suffix)
+    constrain_media(model, df_cm, namespace, paras['EX_SUFFIX'])
 
     # skip the model if it does not grow
     max_growth = model.slim_optimize()
@@ -83,26 +139,48 @@ def add_gapfilled_reactions(gem_file, universe, paras):
         raise RuntimeError("model %s cannot grow in current medium." % (gem_file.rstrip('.xml')))
     else:
         print('add_gapfilled_reaction: max growth rate = %2.2f' % max_growth)
+    return model, max_growth
 
-    #  model before reaction added
-    model_no_gapfill = deepcopy(model)
-    model_w_gapfill = deepcopy(model)
 
-    if add_random_rxns:
-        # randomize reactions in universal pools
-        candidate_reactions = list(set([r.id for r in universe.reactions if r.id not in model_w_gapfill.reactions]))
-        random.shuffle(candidate_reactions)
+# seeds of the random draws of a GEM: RANDOM_SEED, RANDOM_SEED + 1, ..., or consecutive seeds from a random one
+# if RANDOM_SEED is not set
+def draw_seeds(paras):
+    if paras['RANDOM_SEED'] is None:
+        first = random.randrange(2 ** 31)
+    else:
+        first = int(paras['RANDOM_SEED'])
+    return [first + draw for draw in range(int(paras['NUM_RANDOM_DRAWS']))]
+
+
+# candidate reactions in the order they are tried: the reactions of the pool that are not in the model, shuffled
+# by seed, if ADD_RANDOM_RXNS is set; otherwise the reactions predicted by the deep learning model
+def select_candidates(gem_file, model, universe, paras, seed=None):
+    if int(paras['ADD_RANDOM_RXNS']):
+        # randomize reactions in universal pools; sorted first so that a seed gives the same draw in every process
+        candidates = sorted(set([r.id for r in universe.reactions if r.id not in model.reactions]))
+        random.Random(seed).shuffle(candidates)
     else:
         # read deep learning model predicted reactions with scores
-        score_file = "%s/%s.csv" % (paras['GAPFILLED_RXNS_DIRECTORY'], gem_file)
-        df_gapfill = pd.read_csv(score_file, index_col=0)
+        df_gapfill = read_table(paras['GAPFILLED_RXNS_DIRECTORY'], gem_file)
         # keep gapfilled reactions that are not contained in the model but included in the reaction pools
         df_gapfill = df_gapfill.loc[
-            [rid for rid in df_gapfill.index if rid not in model_w_gapfill.reactions and rid in universe.reactions]
+            [rid for rid in df_gapfill.index if rid not in model.reactions and rid in universe.reactions]
         ]
         df_gapfill = df_gapfill[df_gapfill['predicted_scores']>=float(paras['MIN_PREDICTED_SCORES'])].sort_values('similarity_scores')
-        candidate_reactions = list(df_gapfill.index)
-    print('add_gapfilled_reaction: find %d candidate reactions' % len(candidate_reactions))
+        candidates = list(df_gapfill.index)
+    print('add_gapfilled_reaction: find %d candidate reactions' % len(candidates))
+    return candidates
+
+
+# add reactions predicted from deep learning model or randomly selected from reaction pools: the candidate reactions
+# are added to model_w_gapfill in place, in order, up to NUM_GAPFILLED_RXNS_TO_ADD of them; max_growth is its growth
+# rate. Returns the number of reactions added and their ids.
+def fill_gaps(gem_file, model_w_gapfill, max_growth, candidate_reactions, universe, paras):
+    # read parameters
+    namespace = paras['NAMESPACE']
+    batch_size = int(paras['BATCH_SIZE'])
+    max_batch_size = max(int(paras['MAX_BATCH_SIZE']), batch_size)
+    num_rxns_to_fill = int(paras['NUM_GAPFILLED_RXNS_TO_ADD'])
 
     # if Resolve_EGC is True, add reaction one by one; otherwise add all together
     rids_added = []
@@ -110,8 +188,16 @@ def add_gapfilled_reactions(gem_file, universe, paras):
     counter = 0
     counter2 = 0
     max_counter = np.min([num_rxns_to_fill, len(candidate_reactions)])
+    num_tested = 0
+    num_inflating = 0
+    checker = None  # egc checker over model_w_gapfill, built at the first growth inflation
+    screened, may_form_egc = set(), set()  # candidate reactions screened for egcs, and those that may form one
 
     if int(paras['RESOLVE_EGC']):
+        if int(paras['SCREEN_EGC']):
+            checker = EGCChecker(model_w_gapfill, namespace)
+            position = {rid: i for i, rid in enumerate(candidate_reactions)}
+
         while counter < max_counter:
 
             # determine which reactions to add for this batch
@@ -137,47 +223,65 @@ def add_gapfilled_reactions(gem_file, universe, paras):
                 rxns_to_add.append(rxn)
                 counter2 += 1
 
-            # add reactions in batch and test growth inflation
-            is_inflated = test_growth_inflation(model_w_gapfill, rxns_to_add)
-            if is_inflated:
-                # growth inflation found, add reaction one by one, and resolve potential egc
-                for rxn in rxns_to_add:
-                    assert rxn.id not in model_w_gapfill.reactions
-                    is_inflated = test_growth_inflation(model_w_gapfill, [rxn])
-                    if is_inflated:
-                        model_w_gapfill2 = deepcopy(model_w_gapfill)
-                        model_w_gapfill2.add_reactions([rxn])
-                        egc_resolved = resolve_egc(model_w_gapfill2, rxn.id, namespace)
-                        if egc_resolved and model_w_gapfill2.slim_optimize() < 2.81:
-                            model_w_gapfill = deepcopy(model_w_gapfill2)
-                            rids_added.append(rxn.id)
-                            counter += 1
-                            print(
-                                'add_gapfilled_reaction: added %s after resolving egc, current counter = %d'
-                                % (rxn.id, counter))
-                        else:
-                            print(
-                                'add_gapfilled_reaction: failed to add %s and egc not resolved, current counter = %d'
-                                % (rxn.id, counter))
-                    else:
-                        model_w_gapfill.add_reactions([rxn])
-                        rids_added.append(rxn.id)
-                        counter += 1
-                        print(
-                            'add_gapfilled_reaction: added %s, no growth inflation, current counter = %d'
-                            % (rxn.id, counter))
-            else:
-                for rxn in rxns_to_add:
-                    assert rxn.id not in model_w_gapfill.reactions
-                model_w_gapfill.add_reactions(rxns_to_add)
-                rids_added.extend([rxn.id for rxn in rxns_to_add])
-                counter += len(rxns_to_add)
-                print('add_gapfilled_reaction: added %d reactions, no growth inflation, current counter = %d'
-                      % (len(rxns_to_add), counter))
+            if len(rxns_to_add) == 0:
+                break
+
+            # add reactions in batch as if they were added one by one: the reactions before the first one that
+            # inflates the growth rate are added together, that one is added only if its egc can be resolved,
+            # and the rest of the batch is tested again
+            num_tested += len(rxns_to_add)
+            while len(rxns_to_add) > 0:
+                growth = growth_with(model_w_gapfill, rxns_to_add)
+                if np.abs(growth - max_growth) <= 1e-6:
+                    index = len(rxns_to_add)
+                else:
+                    index, growth = first_inflating(model_w_gapfill, rxns_to_add, max_growth)
+                if index > 0:
+                    for rxn in rxns_to_add[:index]:
+                        assert rxn.id not in model_w_gapfill.reactions
+                    model_w_gapfill.add_reactions([rxn.copy() for rxn in rxns_to_add[:index]])
+                    if checker is not None:
+                        checker.add(rxns_to_add[:index])
+                    max_growth = growth
+                    rids_added.extend([rxn.id for rxn in rxns_to_add[:index]])
+                    counter += index
+                    print('add_gapfilled_reaction: added %d reactions, no growth inflation, current counter = %d'
+                          % (index, counter))
+                if index == len(rxns_to_add):
+                    break
+
+                # growth inflation found, resolve potential egc
+                rxn = rxns_to_add[index]
+                num_inflating += 1
+                if checker is None:
+                    checker = EGCChecker(model_w_gapfill, namespace)
+                if int(paras['SCREEN_EGC']) and rxn.id not in screened:
+                    # screen the candidates from this one on, as many as can still be added. The model only gets
+                    # candidates from here on, which the screen adds all together, so a reaction it does not flag
+                    # cannot form an egc when it is checked.
+                    start = position[rxn.id]
+                    window = candidate_reactions[start:start + max_counter - counter]
+                    df_screen = checker.screen([universe.reactions.get_by_id(rid) for rid in window])
+                    screened.update(window)
+                    may_form_egc.update(df_screen.index[df_screen.any(axis=1)])
+                    print('add_gapfilled_reaction: %d of %d screened candidate reactions may form egc'
+                          % (df_screen.any(axis=1).sum(), len(window)))
+                check = not int(paras['SCREEN_EGC']) or rxn.id in may_form_egc
+                growth = add_resolving_egc(model_w_gapfill, rxn, checker, check)
+                if growth is not None:
+                    max_growth = growth
+                    rids_added.append(rxn.id)
+                    counter += 1
+                    print('add_gapfilled_reaction: added %s after resolving egc, current counter = %d' % (rxn.id, counter))
+                else:
+                    print('add_gapfilled_reaction: failed to add %s and egc not resolved, current counter = %d'
+                          % (rxn.id, counter))
+                rxns_to_add = rxns_to_add[index + 1:]
+            batch_size = adapt_batch_size(num_tested, num_inflating, max_batch_size)
     else:
-        max_counter = np.min(paras['NUM_GAPFILLED_RXNS_TO_ADD'], len(candidate_reactions))
-        rxns_to_add = candidate_reactions[0:max_counter]
-        model_w_gapfill.add_reactions([rxns_to_add])
+        rxns_to_add = [universe.reactions.get_by_id(rid).copy() for rid in candidate_reactions[:max_counter]]
+        model_w_gapfill.add_reactions(rxns_to_add)
+        rids_added.extend([rxn.id for rxn in rxns_to_add])
 
     # calculate number of reactions added
     num_rxns_after = len(model_w_gapfill.reactions)
@@ -185,4 +289,4 @@ def add_gapfilled_reactions(gem_file, universe, paras):
     assert num_rxns_added <= max_counter
     print("model %s: successfully added %d reactions." % (gem_file.replace('.xml', ''), num_rxns_added))
 
-    return model_no_gapfill, model_w_gapfill, num_rxns_added, rids_added
+    return num_rxns_added, rids_added
@@ -1,6 +1,7 @@
 from predict import *
 from similarity import *
 from validate import *
+from pipeline import run_pipeline
 import os
 import logging
 logging.disable()
@@ -8,22 +9,14 @@ logging.disable()
 
 def main():
     # create results folder
-    os.system("mkdir results")
-    os.system("mkdir results/predicted_scores")
-    os.system("mkdir results/similarity_scores")
-    os.system("mkdir results/gaps")
+    for directory in ['results/predicted_scores', 'results/similarity_scores', 'results/gaps']:
+        os.makedirs(directory, exist_ok=True)
 
-    # predict scores for reactions in reaction pool
-    repeat = 5
-    for i in range(repeat):
-        get_prediction_score(name='zimmermann')
-
-    # predict mean similarity between candidate reactions and existing reactions
-    get_similarity_score(name='zimmermann', top_N=2000)
-
-    # predict metabolic phenotypes
-    # If you only want prediction and similarity scores, comment out the following line
-    validate()
+    # predict scores for reactions in reaction pool (an ensemble of 5 models is trained per GEM), mean similarity
+    # between every candidate reaction and existing reactions, and metabolic phenotypes. Each stage only
+    # runs for the GEMs whose inputs changed since it last completed; see pipeline.py
+    # If you only want prediction and similarity scores, pass predict_phenotypes=False
+    run_pipeline(name='zimmermann', repeat=5, top_N=None)
 
 
 if __name__ == "__main__":
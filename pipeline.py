@@ -0,0 +1,163 @@
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+import predict
+import profiler
+import read_paras
+import validate
+from pool import file_digest
+from scores import has_store, store_path
+from similarity import get_similarity_score
+from utils import get_filenames
+
+PIPELINE_DIRECTORY = './results/pipeline'
+PIPELINE_VERSION = 1  # bump when a stage changes what it computes from the same inputs
+
+# arguments of config.parse() that change how a stage runs but not its results
+RUNTIME_ARGS = ['export_csv', 'num_workers', 'num_threads', 'profile_directory', 'trace_memory', 'cprofile',
+                'chunk_size', 'max_chunk_edges']
+
+# fields of input_parameters.txt that do not enter the results of a GEM; files enter by their content instead
+RUNTIME_FIELDS = ['NUM_CPUS', 'OUTPUT_DIRECTORY', 'OUTPUT_FILENAME', 'FVA_PROCESSES', 'KEY_RXN_PROCESSES',
+                  'PROFILE_DIRECTORY', 'TRACE_MEMORY', 'CPROFILE', 'GEMs']
+FILE_FIELDS = ['CULTURE_MEDIUM', 'REACTION_POOL', 'GEM_DIRECTORY', 'GAPFILLED_RXNS_DIRECTORY', 'SUBSTRATE_EX_RXNS']
+
+
+# digest of the content of files and directories, a directory standing for all files below it
+def content_digest(paths):
+    sha = hashlib.sha256()
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, f) for root, _, names in os.walk(path) for f in names)
+        else:
+            files = [path]
+        for f in files:
+            sha.update(os.path.relpath(f, path).encode())
+            sha.update(file_digest(f).encode())
+    return sha.hexdigest()
+
+
+# the scores of a GEM in a directory, as a store or as a csv export
+def score_files(directory, name):
+    return store_path(directory, name) if has_store(directory, name) else '%s/%s.csv' % (directory, name)
+
+
+def stage_key(inputs):
+    inputs = json.dumps({'version': PIPELINE_VERSION, 'inputs': inputs}, sort_keys=True, default=str)
+    return hashlib.sha256(inputs.encode()).hexdigest()[:16]
+
+
+# one manifest per GEM and stage, <directory>/<gem>.<stage>.json, holding the key of the inputs the stage last
+# completed with and the files it wrote. It is written once the outputs are complete, so a stage interrupted
+# before that is stale and runs again.
+class Manifest:
+    def __init__(self, directory=PIPELINE_DIRECTORY):
+        self.directory = directory
+
+    def path(self, gem, stage):
+        return '%s/%s.%s.json' % (self.directory, gem, stage)
+
+    def fresh(self, gem, stage, key):
+        if not os.path.exists(self.path(gem, stage)):
+            return False
+        with open(self.path(gem, stage)) as f:
+            manifest = json.load(f)
+        return manifest['key'] == key and all(os.path.exists(output) for output in manifest['outputs'])
+
+    def record(self, gem, stage, key, inputs, outputs):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(gem, stage) + '.tmp', 'w') as f:
+            json.dump({'key': key, 'inputs': inputs, 'outputs': outputs}, f, indent=1, default=str)
+        os.replace(self.path(gem, stage) + '.tmp', self.path(gem, stage))
+
+    def invalidate(self, gem, stage):
+        if os.path.exists(self.path(gem, stage)):
+            os.remove(self.path(gem, stage))
+
+
+# GEMs whose stage is stale, with the key and the inputs of each
+def stale(manifest, stage, inputs):
+    keys = {gem: stage_key(gem_inputs) for gem, gem_inputs in inputs.items()}
+    return {gem: (keys[gem], inputs[gem]) for gem in inputs if not manifest.fresh(gem, stage, keys[gem])}
+
+
+# predict scores, similarity and fermentation phenotypes for the GEMs of ./data/<name>, rerunning a stage only for
+# the GEMs whose inputs changed since it last completed: the GEM file, the reaction pool, the arguments of
+# config.parse(), the outputs of the stage before and, for the phenotypes, the fields of input_file and the files
+# they name. Phenotypes of random reactions are never reused unless RANDOM_SEED is set. The similarity of every
+# candidate is scored unless top_N limits it to the top_N highest predicted reactions.
+def run_pipeline(name, repeat=1, top_N=None, input_file='input_parameters.txt', predict_phenotypes=True,
+                 manifest=None):
+    manifest = Manifest() if manifest is None else manifest
+    path = './data/' + name
+    gems = [sample[:-4] for sample in get_filenames(path) if sample.endswith('.xml')]
+    pool_digest = file_digest(predict.POOL_FILE)
+    args = {k: v for k, v in sorted(vars(predict.args).items()) if k not in RUNTIME_ARGS}
+
+    # predicted scores; the scores and models of a stale GEM are replaced, not appended to
+    scores_directory = './results/predicted_scores'
+    todo_predict = stale(manifest, 'predict', {gem: {'gem': file_digest('%s/%s.xml' % (path, gem)), 'pool': pool_digest,
+                                             'args': args, 'repeat': repeat} for gem in gems})
+    for gem in todo_predict:
+        manifest.invalidate(gem, 'predict')
+        for directory in [store_path(scores_directory, gem), '%s/%s' % (predict.MODEL_DIRECTORY, gem)]:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+
+    def predicted(sample):
+        key, inputs = todo_predict[sample[:-4]]
+        manifest.record(sample[:-4], 'predict', key, inputs, [store_path(scores_directory, sample[:-4])])
+
+    print('pipeline: predicting scores of %d of %d GEMs' % (len(todo_predict), len(gems)))
+    if len(todo_predict) > 0:
+        predict.get_prediction_score(name, repeat, samples=[gem + '.xml' for gem in todo_predict], callback=predicted)
+
+    # similarity to the reactions of the GEM
+    similarity_directory = './results/similarity_scores'
+    todo_similarity = stale(manifest, 'similarity', {gem: {'scores': content_digest([score_files(scores_directory, gem)]),
+                                                'gem': file_digest('%s/%s.xml' % (path, gem)), 'pool': pool_digest,
+                                                'top_N': top_N} for gem in gems})
+
+    def scored(sample):
+        key, inputs = todo_similarity[sample]
+        outputs = [store_path(similarity_directory, sample), '%s/%s.csv' % (similarity_directory, sample)]
+        manifest.record(sample, 'similarity', key, inputs, outputs)
+
+    print('pipeline: scoring similarity of %d of %d GEMs' % (len(todo_similarity), len(gems)))
+    if len(todo_similarity) > 0:
+        get_similarity_score(name, top_N, samples=list(todo_similarity), callback=scored)
+    if not predict_phenotypes:
+        return None
+
+    # fermentation phenotypes, one table per GEM, gathered into the output file
+    paras = read_paras.read(input_file)
+    gem_files = sorted(paras['GEMs'].split(';'))
+    fields = {f: str(v) for f, v in paras.items() if f not in RUNTIME_FIELDS + FILE_FIELDS}
+    files = {f: file_digest(paras[f]) for f in ['CULTURE_MEDIUM', 'REACTION_POOL', 'SUBSTRATE_EX_RXNS']}
+    inputs = {gem: {'gem': file_digest('%s/%s.xml' % (paras['GEM_DIRECTORY'], gem)),
+                    'scores': content_digest([score_files(paras['GAPFILLED_RXNS_DIRECTORY'], gem)]),
+                    'files': files, 'fields': fields} for gem in gem_files}
+    if int(paras['ADD_RANDOM_RXNS']) and paras['RANDOM_SEED'] is None:
+        for gem in gem_files:
+            manifest.invalidate(gem, 'validate')
+    todo_validate = stale(manifest, 'validate', inputs)
+
+    def phenotypes_file(gem):
+        return '%s/%s.validate.csv' % (manifest.directory, gem)
+
+    def simulated(gem, df):
+        key, gem_inputs = todo_validate[gem]
+        df.to_csv(phenotypes_file(gem) + '.tmp', index=False)
+        os.replace(phenotypes_file(gem) + '.tmp', phenotypes_file(gem))
+        manifest.record(gem, 'validate', key, gem_inputs, [phenotypes_file(gem)])
+
+    print('pipeline: simulating %d of %d GEMs with solver %s' % (len(todo_validate), len(gem_files), paras['SOLVER']))
+    if len(todo_validate) > 0:
+        os.makedirs(manifest.directory, exist_ok=True)
+        validate.simulate(paras, list(todo_validate), simulated)
+    output_file = "%s/%s" % (paras['OUTPUT_DIRECTORY'], paras['OUTPUT_FILENAME'])
+    pd.concat([pd.read_csv(phenotypes_file(gem)) for gem in gem_files]).to_csv(output_file, index=False)
+    profiler.write_summary()
+    print('done!')
@@ -0,0 +1,131 @@
+import os
+import hashlib
+import pickle
+import numpy as np
+import cobra
+from scipy import sparse
+from cobra.util.array import create_stoichiometric_matrix
+from profiler import stage
+
+CACHE_DIRECTORY = './data/pools/cache'
+CACHE_VERSION = 2  # bump when the cached ReactionPool layout changes
+
+
+# sparse (CSC) stoichiometric matrix, never densified
+def get_stoichiometric_matrix(model):
+    stoichiometric_matrix = create_stoichiometric_matrix(model, array_type='lil').tocsc()
+    stoichiometric_matrix.eliminate_zeros()
+    return stoichiometric_matrix
+
+
+# a parsed reaction pool together with its stoichiometric matrix and id indices
+class ReactionPool:
+    def __init__(self, model):
+        self.model = model
+        self.metabolites = [met.id for met in model.metabolites]
+        self.reactions = [rxn.id for rxn in model.reactions]
+        self.met_index = {mid: i for i, mid in enumerate(self.metabolites)}
+        self.rxn_index = {rid: i for i, rid in enumerate(self.reactions)}
+        self.stoichiometric_matrix = get_stoichiometric_matrix(model)
+        # column order of reactions sorted by id, i.e. the candidate order of a merged DataFrame
+        self.sorted_order = np.argsort(np.array(self.reactions))
+        self.sorted_position = np.empty(len(self.reactions), dtype=np.int64)
+        self.sorted_position[self.sorted_order] = np.arange(len(self.reactions))
+
+    def extend(self, model):
+        return ExtendedPool(self, model)
+
+
+# the pool extended by the metabolites and reactions of one model; the pool itself is shared, not copied
+class ExtendedPool:
+    def __init__(self, pool, model):
+        self.pool = pool
+        self.model_reactions = [rxn.id for rxn in model.reactions]
+        new_rxns = [rxn for rxn in model.reactions if rxn.id not in pool.rxn_index]
+
+        # as in cobra's merge, reactions already in the pool keep the pool stoichiometry
+        met_index = {}
+        row, col, data = [], [], []
+        for j, rxn in enumerate(new_rxns):
+            for met, coefficient in rxn.metabolites.items():
+                if met.id in pool.met_index:
+                    row.append(pool.met_index[met.id])
+                else:
+                    if met.id not in met_index:
+                        met_index[met.id] = len(pool.metabolites) + len(met_index)
+                    row.append(met_index[met.id])
+                col.append(j)
+                data.append(coefficient)
+        self.metabolites = list(met_index)
+        self.reactions = [rxn.id for rxn in new_rxns]
+        self.rxn_index = {rid: i for i, rid in enumerate(self.reactions)}
+        self.num_metabolites = len(pool.metabolites) + len(self.metabolites)
+        self.stoichiometric_matrix = sparse.csc_matrix(
+            (data, (row, col)), shape=(self.num_metabolites, len(new_rxns)), dtype=float)
+        self.stoichiometric_matrix.eliminate_zeros()
+
+    # ids of the rows of columns() and candidates()
+    def metabolite_ids(self):
+        return self.pool.metabolites + self.metabolites
+
+    def _pool_columns(self, index):
+        matrix = self.pool.stoichiometric_matrix[:, index]
+        return sparse.csc_matrix((matrix.data, matrix.indices, matrix.indptr), shape=(self.num_metabolites, len(index)))
+
+    # stoichiometric columns of the given reactions over pool and model metabolites
+    def columns(self, rxn_ids):
+        in_pool = np.array([rid in self.pool.rxn_index for rid in rxn_ids], dtype=bool)
+        pool_matrix = self._pool_columns([self.pool.rxn_index[rid] for rid in np.array(rxn_ids)[in_pool]])
+        if in_pool.all():
+            return pool_matrix
+        new_matrix = self.stoichiometric_matrix[:, [self.rxn_index[rid] for rid in np.array(rxn_ids)[~in_pool]]]
+        matrix = sparse.hstack((pool_matrix, new_matrix), format='csc')
+        return matrix[:, np.argsort(np.concatenate((np.where(in_pool)[0], np.where(~in_pool)[0])))]
+
+    # pool reactions missing from the model, sorted by id
+    def candidates(self):
+        mask = np.ones(len(self.pool.reactions), dtype=bool)
+        in_model = [self.pool.rxn_index[rid] for rid in self.model_reactions if rid in self.pool.rxn_index]
+        mask[self.pool.sorted_position[in_model]] = False
+        index = self.pool.sorted_order[mask]
+        return self._pool_columns(index), np.array(self.pool.reactions)[index]
+
+
+def file_digest(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# load a reaction pool from the on-disk cache; the cache is keyed by the content of the sbml file
+@stage('load_pool')
+def load_pool(filename, cache_directory=CACHE_DIRECTORY):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    key = '%s-%s-%d' % (file_digest(filename), cobra.__version__, CACHE_VERSION)
+    key = hashlib.sha256(key.encode()).hexdigest()[:16]
+    cache_prefix = '%s/%s.%s' % (cache_directory, name, key)
+    if os.path.exists(cache_prefix + '.pkl'):
+        try:
+            with open(cache_prefix + '.pkl', 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            # unreadable cache (e.g. written by an interrupted run); rebuild it
+            pass
+
+    pool = ReactionPool(cobra.io.read_sbml_model(filename))
+    os.makedirs(cache_directory, exist_ok=True)
+    # remove the files of older versions of this pool; files of the current key and temporary files of other
+    # processes building it at the same time are kept, and files already removed by them are skipped
+    for f in os.listdir(cache_directory):
+        if f.startswith(name + '.') and not f.startswith('%s.%s.' % (name, key)) and not f.endswith('.tmp'):
+            try:
+                os.remove('%s/%s' % (cache_directory, f))
+            except FileNotFoundError:
+                pass
+    tmp_file = '%s.pkl.%d.tmp' % (cache_prefix, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(pool, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_prefix + '.pkl')
+    return pool
@@ -4,61 +4,305 @@ from CHESHIRE import CHESHIRE
 from tqdm import tqdm
 import config
 import pandas as pd
-import cobra
-from os.path import exists
+import os
+import copy
+from scores import ScoreStore, store_path, write_store
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import profiler
+from profiler import stage
 
 args = config.parse()
 
+POOL_FILE = './data/pools/bigg_universe.xml'
+MODEL_DIRECTORY = './results/models'
 
-def train(feature, y, incidence_matrix, model, optimizer):
+
+def train(feature, y, hypergraph, model, optimizer):
     model.train()
     optimizer.zero_grad()
-    y_pred = model(feature, incidence_matrix)
+    y_pred = model(feature, hypergraph)
     loss = hyperlink_score_loss(y_pred, y)
     loss.backward()
     optimizer.step()
+    return loss.item()
 
 
-def predict(feature, incidence_matrix, model):
+def predict(feature, hypergraph, model):
     model.eval()
     with torch.no_grad():
-        y_pred = model(feature, incidence_matrix)
+        y_pred = model(feature, hypergraph)
     return torch.squeeze(y_pred)
 
 
-def get_prediction_score(name):
-    path = './data/' + name
-    namelist = get_filenames(path)
-    universe_pool = cobra.io.read_sbml_model('./data/pools/bigg_universe.xml')
-    for sample in namelist:
-        if sample.endswith('.xml'):
-            universe_pool_copy = universe_pool.copy()
-            rxn_df, rxn_pool_df = get_data_from_pool2(path, sample, universe_pool_copy)
-            incidence_matrix_pos = np.abs(rxn_df.to_numpy()) > 0
-            incidence_matrix_pos = torch.tensor(incidence_matrix_pos, dtype=torch.float)
-            incidence_matrix_pos = torch.unique(incidence_matrix_pos, dim=1)
-            incidence_matrix_cand = np.abs(rxn_pool_df.to_numpy()) > 0
-            incidence_matrix_cand = torch.tensor(incidence_matrix_cand, dtype=torch.int64)
-
-            incidence_matrix_neg = create_neg_incidence_matrix(incidence_matrix_pos)
-            incidence_matrix_neg = torch.unique(incidence_matrix_neg, dim=1)
-            incidence_matrix = torch.cat((incidence_matrix_pos, incidence_matrix_neg), dim=1)
-            y = create_label(incidence_matrix_pos, incidence_matrix_neg)
-            model = CHESHIRE(input_dim=incidence_matrix_pos.shape, emb_dim=args.emb_dim, conv_dim=args.conv_dim, k=args.k, p=args.p)
-            optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
-            for _ in tqdm(range(args.max_epoch)):
-                train(incidence_matrix_pos, y, incidence_matrix, model, optimizer)
-            score = predict(incidence_matrix_pos, incidence_matrix_cand, model)
-            score_df = pd.DataFrame(data=score.detach().numpy(), index=rxn_pool_df.columns)
-            if exists('./results/predicted_scores/' + sample[:-4] + '.csv'):
-                exist_score_df = pd.read_csv('./results/predicted_scores/' + sample[:-4] + '.csv', index_col=0)
-                score_df = pd.concat([exist_score_df, score_df], axis=1)
-                score_df.to_csv('./results/predicted_scores/' + sample[:-4] + '.csv')
+# split hyperedges into column ranges holding at most chunk_size hyperedges and max_edges clique edges
+def iter_chunks(incidence_matrix, chunk_size=0, max_edges=0):
+    num_edges = incidence_matrix.shape[1]
+    degree = torch.bincount(create_hyperedge_index(incidence_matrix)[1], minlength=num_edges)
+    cost = torch.cumsum(degree * (degree - 1), dim=0)
+    start = 0
+    while start < num_edges:
+        stop = num_edges if chunk_size <= 0 else min(start + chunk_size, num_edges)
+        if max_edges > 0:
+            offset = cost[start - 1] if start > 0 else 0
+            budget_stop = int(torch.searchsorted(cost, offset + max_edges, right=True))
+            stop = min(stop, max(start + 1, budget_stop))
+        yield start, stop
+        start = stop
+
+
+# score candidate hyperedges chunk by chunk so that only one chunk is expanded at a time;
+# every chunk is expanded once and scored by all models of the ensemble
+def predict_chunks(feature, incidence_matrix, models, chunk_size=0, max_edges=0):
+    xs = []
+    for model in models:
+        model.eval()
+        with torch.no_grad():
+            xs.append(model.encode(feature))
+    for start, stop in iter_chunks(incidence_matrix, chunk_size, max_edges):
+        hypergraph = CHESHIRE.prepare(select_columns(incidence_matrix, torch.arange(start, stop)))
+        with torch.no_grad():
+            y_pred = torch.stack([model.score(x, hypergraph).view(-1) for model, x in zip(models, xs)], dim=1)
+        yield start, stop, y_pred
+
+
+# held-out positive hyperlinks and one fixed sample of negatives, expanded once for all validations
+def validation_set(incidence_matrix_val):
+    incidence_matrix_neg = unique_columns(create_neg_incidence_matrix(incidence_matrix_val))
+    hypergraph = CHESHIRE.concat(CHESHIRE.prepare(incidence_matrix_val), CHESHIRE.prepare(incidence_matrix_neg))
+    return hypergraph, create_label(incidence_matrix_val, incidence_matrix_neg)
+
+
+# train one model on the positive hyperlinks and its own sample of negative hyperlinks;
+# with --resample_neg, fresh negatives are drawn every epoch. Given validation hyperlinks, the model is
+# validated every --val_interval epochs and training stops once the validation loss has not improved
+# for --patience validations; the weights of the best validation are restored.
+@stage('training')
+def train_model(incidence_matrix_pos, seed=None, incidence_matrix_val=None):
+    if seed is not None:
+        torch.manual_seed(seed)
+    model = CHESHIRE(input_dim=incidence_matrix_pos.shape, emb_dim=args.emb_dim, conv_dim=args.conv_dim, k=args.k, p=args.p)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    hypergraph_pos = CHESHIRE.prepare(incidence_matrix_pos)
+    if incidence_matrix_val is not None:
+        hypergraph_val, y_val = validation_set(incidence_matrix_val)
+    metrics = []
+    best_loss, best_state, num_bad = float('inf'), None, 0
+    for epoch in tqdm(range(args.max_epoch)):
+        with stage('epoch', epoch=epoch + 1):
+            if epoch == 0 or args.resample_neg:
+                with stage('negative_sampling'):
+                    incidence_matrix_neg = create_neg_incidence_matrix(incidence_matrix_pos)
+                    incidence_matrix_neg = unique_columns(incidence_matrix_neg)
+                hypergraph = CHESHIRE.concat(hypergraph_pos, CHESHIRE.prepare(incidence_matrix_neg))
+                y = create_label(incidence_matrix_pos, incidence_matrix_neg)
+            metrics.append({'epoch': epoch + 1, 'train_loss': train(incidence_matrix_pos, y, hypergraph, model, optimizer)})
+            if incidence_matrix_val is None or (epoch + 1) % args.val_interval != 0:
+                continue
+            y_pred = predict(incidence_matrix_pos, hypergraph_val, model)
+            val_loss = hyperlink_score_loss(y_pred, y_val).item()
+            metrics[-1].update(val_loss=val_loss, val_auc=auc_score(y_pred, y_val))
+            if val_loss < best_loss:
+                best_loss, best_state, num_bad = val_loss, copy.deepcopy(model.state_dict()), 0
+                metrics[-1]['best'] = True
             else:
-                score_df.to_csv('./results/predicted_scores/' + sample[:-4] + '.csv')
+                num_bad += 1
+                if num_bad >= args.patience:
+                    break
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    return model, metrics
+
+
+# everything needed to score new candidates with a trained model: its weights and hyperparameters,
+# the node feature matrix it was trained on and the metabolite ids of the feature rows
+def make_checkpoint(model, feature, metabolites, reactions, seed, metrics):
+    hyperparameters = {'input_dim': tuple(feature.shape), 'emb_dim': args.emb_dim, 'conv_dim': args.conv_dim,
+                       'k': args.k, 'p': args.p}
+    return {'state_dict': model.state_dict(), 'hyperparameters': hyperparameters, 'feature': feature,
+            'metabolites': metabolites, 'reactions': reactions, 'seed': seed, 'metrics': metrics}
+
+
+# prepare the data of one GEM once and score its candidate reactions with an ensemble of repeat models.
+# With --patience, a share of the GEM's reactions is held out for early stopping and the models (and their
+# node features) only see the rest.
+def score_sample(path, sample, pool, repeat=1):
+    with profiler.session(sample[:-4], 'predict'):
+        return _score_sample(path, sample, pool, repeat)
+
+
+def _score_sample(path, sample, pool, repeat):
+    model = get_data(path, sample)[0]
+    with stage('assemble_matrices'):
+        extended_pool = pool.extend(model)
+        rxn_matrix = extended_pool.columns(extended_pool.model_reactions)
+        rxn_pool_matrix, rxn_pool = extended_pool.candidates()
+        incidence_matrix_pos = create_incidence_matrix(rxn_matrix, dtype=torch.float)
+        incidence_matrix_pos = unique_columns(incidence_matrix_pos)
+        incidence_matrix_cand = create_incidence_matrix(rxn_pool_matrix, dtype=torch.int64)
+
+    incidence_matrix_val = None
+    if args.patience > 0:
+        if args.seed is not None:
+            torch.manual_seed(args.seed)
+        incidence_matrix_pos, incidence_matrix_val = split_hyperlinks(incidence_matrix_pos, args.train_size, args.test_size)
+
+    seeds = [None] * repeat if args.seed is None else [args.seed + i for i in range(repeat)]
+    models, metrics = zip(*[train_model(incidence_matrix_pos, seed, incidence_matrix_val) for seed in seeds])
+    # the scores of each chunk go straight to the reserved columns of the GEM's score store
+    columns = ScoreStore(store_path('./results/predicted_scores', sample[:-4])).reserve(rxn_pool, repeat)
+    with stage('scoring'):
+        for start, stop, chunk_score in predict_chunks(incidence_matrix_pos, incidence_matrix_cand, models,
+                                                       args.chunk_size, args.max_chunk_edges):
+            for j, column in enumerate(columns):
+                column[start:stop] = chunk_score[:, j].numpy()
+        for column in columns:
+            column.flush()
+    checkpoints = [make_checkpoint(model, incidence_matrix_pos, extended_pool.metabolite_ids(),
+                                   extended_pool.model_reactions, seed, model_metrics)
+                   for model, seed, model_metrics in zip(models, seeds, metrics)]
+    return checkpoints
+
+
+# commit the scored columns to the GEM's score store and save one checkpoint per run, named after its score
+# column; the csv export is optional
+def write_scores(sample, checkpoints):
+    store = ScoreStore(store_path('./results/predicted_scores', sample[:-4]))
+    runs = [str(store.count + j) for j in range(len(checkpoints))]
+    save_checkpoints(sample[:-4], runs, checkpoints)
+    store.commit(len(checkpoints), runs)
+    if args.export_csv:
+        store.to_csv('./results/predicted_scores/' + sample[:-4] + '.csv')
+
+
+# the training metrics of every run are also written as csv, one row per epoch
+def save_checkpoints(name, runs, checkpoints):
+    os.makedirs(MODEL_DIRECTORY + '/' + name, exist_ok=True)
+    for run, checkpoint in zip(runs, checkpoints):
+        torch.save(checkpoint, '%s/%s/run%s.pt' % (MODEL_DIRECTORY, name, run))
+        pd.DataFrame(checkpoint['metrics']).to_csv('%s/%s/run%s_metrics.csv' % (MODEL_DIRECTORY, name, run), index=False)
+
+
+# checkpoints of a GEM ordered by run
+def load_checkpoints(name):
+    directory = MODEL_DIRECTORY + '/' + name
+    files = [f for f in os.listdir(directory) if f.startswith('run') and f.endswith('.pt')] if os.path.isdir(directory) else []
+    runs = sorted((f[len('run'):-len('.pt')] for f in files), key=int)
+    return runs, [torch.load('%s/run%s.pt' % (directory, run)) for run in runs]
+
+
+def load_model(checkpoint):
+    model = CHESHIRE(**checkpoint['hyperparameters'])
+    model.load_state_dict(checkpoint['state_dict'])
+    model.eval()
+    return model
+
+
+# reorder the rows of a candidate matrix, given by metabolite ids, into the feature rows of a checkpoint;
+# metabolites the checkpoint has never seen get new rows after the known ones
+def align_metabolites(checkpoint_metabolites, metabolites, matrix):
+    matrix = sparse.csc_matrix(matrix)
+    met_index = {mid: i for i, mid in enumerate(checkpoint_metabolites)}
+    row_map = np.array([met_index.get(mid, -1) for mid in metabolites], dtype=np.int64)
+    used = np.zeros(len(metabolites), dtype=bool)
+    used[matrix.indices] = True
+    unknown = used & (row_map < 0)
+    row_map[unknown] = len(checkpoint_metabolites) + np.arange(unknown.sum())
+    num_rows = len(checkpoint_metabolites) + int(unknown.sum())
+    return sparse.csc_matrix((matrix.data, row_map[matrix.indices], matrix.indptr), shape=(num_rows, matrix.shape[1]))
+
+
+# score a candidate matrix, whose rows are the given metabolite ids, with trained checkpoints (one score
+# column per checkpoint). Metabolites unknown to a checkpoint take part in no training hyperlink, so their
+# feature rows are zero, as for pool metabolites absent from the GEM during training.
+def score_checkpoints(checkpoints, metabolites, candidate_matrix):
+    score = np.empty((candidate_matrix.shape[1], len(checkpoints)), dtype=np.float32)
+    # checkpoints trained on the same hyperlinks share their feature matrix and candidate expansion
+    groups = {}
+    for j, checkpoint in enumerate(checkpoints):
+        key = (tuple(checkpoint['metabolites']), checkpoint['feature'].coalesce().indices().numpy().tobytes())
+        groups.setdefault(key, []).append(j)
+    for columns in groups.values():
+        checkpoint = checkpoints[columns[0]]
+        aligned = align_metabolites(checkpoint['metabolites'], metabolites, candidate_matrix)
+        feature = checkpoint['feature'].coalesce()
+        feature = torch.sparse_coo_tensor(feature.indices(), feature.values(), (aligned.shape[0], feature.shape[1]))
+        models = [load_model(checkpoints[j]) for j in columns]
+        incidence_matrix_cand = create_incidence_matrix(aligned, dtype=torch.int64)
+        for start, stop, chunk_score in predict_chunks(feature, incidence_matrix_cand, models,
+                                                       args.chunk_size, args.max_chunk_edges):
+            score[start:stop, columns] = chunk_score.numpy()
+    return score
+
+
+# re-score the GEMs of a dataset against a (new) reaction pool with their saved checkpoints, without
+# retraining; the scores replace the GEM's score store, one column per checkpoint
+def rescore(name, pool_file=POOL_FILE):
+    path = './data/' + name
+    pool = load_pool(pool_file)
+    for sample in [sample for sample in get_filenames(path) if sample.endswith('.xml')]:
+        runs, checkpoints = load_checkpoints(sample[:-4])
+        if len(checkpoints) == 0:
+            raise RuntimeError('no checkpoints of %s in %s.' % (sample[:-4], MODEL_DIRECTORY))
+        model_reactions = set(checkpoints[0]['reactions'])
+        index = [i for i in pool.sorted_order if pool.reactions[i] not in model_reactions]
+        rxn_pool = np.array(pool.reactions)[index]
+        score = score_checkpoints(checkpoints, pool.metabolites, pool.stoichiometric_matrix[:, index])
+        write_store('./results/predicted_scores', sample[:-4], pd.DataFrame(score, index=rxn_pool, columns=runs))
+        if args.export_csv:
+            ScoreStore(store_path('./results/predicted_scores', sample[:-4])).to_csv(
+                './results/predicted_scores/' + sample[:-4] + '.csv')
+
+
+# each worker process loads the pool once and keeps its torch threads within its budget
+_worker_pool = None
+
+
+def _init_worker(pool_file, num_threads):
+    global _worker_pool
+    torch.set_num_threads(num_threads)
+    configure_profiler()
+    _worker_pool = load_pool(pool_file)
+
+
+def _score_sample_worker(path, sample, repeat):
+    return sample, score_sample(path, sample, _worker_pool, repeat)
+
+
+def configure_profiler():
+    profiler.configure(args.profile_directory, args.trace_memory, args.cprofile)
+
+
+# samples, if given, are the GEM files to score instead of all of them; callback(sample) is called once the
+# scores of a GEM are written
+def get_prediction_score(name, repeat=1, samples=None, callback=None):
+    path = './data/' + name
+    if samples is None:
+        namelist = get_filenames(path)
+        samples = [sample for sample in namelist if sample.endswith('.xml')]
+    configure_profiler()
+    universe_pool = load_pool(POOL_FILE)
+    if args.num_workers <= 1:
+        for sample in samples:
+            write_scores(sample, score_sample(path, sample, universe_pool, repeat))
+            if callback is not None:
+                callback(sample)
+        profiler.write_summary()
+        return
+
+    # train several GEMs concurrently, largest first, and write each one as soon as it finishes
+    samples = sorted(samples, key=lambda sample: os.path.getsize(path + '/' + sample), reverse=True)
+    num_threads = args.num_threads if args.num_threads > 0 else max(1, os.cpu_count() // args.num_workers)
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=_init_worker,
+                             initargs=(POOL_FILE, num_threads)) as executor:
+        futures = [executor.submit(_score_sample_worker, path, sample, repeat) for sample in samples]
+        for future in as_completed(futures):
+            sample, result = future.result()
+            write_scores(sample, result)
+            if callback is not None:
+                callback(sample)
+    profiler.write_summary()
 
 
 #if __name__ == "__main__":
-#    repeat = 5
-#    for i in range(repeat):
-#        main(name='zimmermann')
+#    get_prediction_score(name='zimmermann', repeat=5)
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import resource
+import cProfile
+import functools
+import tracemalloc
+import pandas as pd
+
+REPORT_DIRECTORY = './results/profiles'
+
+_settings = {'directory': REPORT_DIRECTORY, 'trace_memory': False, 'cprofile': False}
+_records = []  # records of the stages run in the open sessions
+_sessions = []
+_stack = []
+_pipeline = {}  # totals per stage of the stages run outside any session, for pipeline.json
+_memory = {'process_peak': 0.0, 'resettable': os.path.exists('/proc/self/clear_refs')}
+
+
+# where reports go and which of the costlier probes (tracemalloc, cProfile) are switched on
+def configure(directory=REPORT_DIRECTORY, trace_memory=False, cprofile=False):
+    _settings.update(directory=directory, trace_memory=bool(trace_memory), cprofile=bool(cprofile))
+    if _settings['trace_memory'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+# current resident set size of the process and its peak since the last reset_rss_peak(), in MB. They are read from
+# /proc/self/status on linux; elsewhere only the peak of the whole process is known, from getrusage, and stands
+# in for both.
+def rss():
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['VmRSS'].split()[0]) / 1024, int(fields['VmHWM'].split()[0]) / 1024
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    return peak, peak
+
+
+# restart the peak resident set size at the current size, where the kernel allows it (linux clear_refs); the
+# peak so far is kept for peak_rss()
+def reset_rss_peak():
+    if not _memory['resettable']:
+        return
+    _memory['process_peak'] = max(_memory['process_peak'], rss()[1])
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        _memory['resettable'] = False
+
+
+# peak resident set size of the whole process so far, in MB
+def peak_rss():
+    return max(_memory['process_peak'], rss()[1])
+
+
+# times a stage of the pipeline, as a context manager or as a decorator; every run appends one record with its
+# wall time, the peak resident set size while it ran and its change from entry to exit, the peak of the whole
+# process so far and, with trace_memory, the peak of the python allocations made while it ran. Peaks include
+# nested stages. Where the peak resident set size cannot be reset, the peak of a stage is that of the process.
+class stage:
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(self.name, **self.info):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        self.traced_peak = 0
+        if tracemalloc.is_tracing():
+            if len(_stack) > 0:
+                _stack[-1].traced_peak = max(_stack[-1].traced_peak, tracemalloc.get_traced_memory()[1])
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        current, peak = rss()
+        if len(_stack) > 0:
+            _stack[-1].rss_peak = max(_stack[-1].rss_peak, peak)
+        reset_rss_peak()
+        self.rss_start = self.rss_peak = current
+        _stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        _stack.pop()
+        current, peak = rss()
+        self.rss_peak = max(self.rss_peak, peak)
+        record = {'stage': self.name, 'seconds': seconds, 'peak_rss_mb': self.rss_peak,
+                  'rss_delta_mb': current - self.rss_start, 'process_peak_rss_mb': peak_rss()}
+        if len(_stack) > 0:
+            _stack[-1].rss_peak = max(_stack[-1].rss_peak, self.rss_peak)
+        reset_rss_peak()
+        if tracemalloc.is_tracing():
+            self.traced_peak = max(self.traced_peak, tracemalloc.get_traced_memory()[1])
+            record['traced_peak_mb'] = self.traced_peak / 1024 / 1024
+            if len(_stack) > 0:
+                _stack[-1].traced_peak = max(_stack[-1].traced_peak, self.traced_peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        record.update(self.info)
+        if len(_sessions) > 0:
+            _records.append(record)
+        else:
+            add_to_pipeline(record)
+        return False
+
+
+# folds a record of a stage run outside any session into the totals of its stage, so that a process that never
+# writes a summary does not accumulate records
+def add_to_pipeline(record):
+    total = _pipeline.setdefault(record['stage'], {'stage': record['stage'], 'count': 0, 'seconds': 0.0,
+                                                   'peak_rss_mb': 0.0, 'rss_delta_mb': 0.0, 'process_peak_rss_mb': 0.0})
+    total['count'] += 1
+    for key in ['seconds', 'rss_delta_mb']:
+        total[key] += record[key]
+    for key in ['peak_rss_mb', 'process_peak_rss_mb', 'traced_peak_mb']:
+        if key in record:
+            total[key] = max(total.get(key, 0.0), record[key])
+
+
+# collects the stages run for one GEM in one part of the pipeline (e.g. predict, validate) and writes
+# them to <directory>/<gem>.<part>.json; with cprofile, the whole session is profiled to a .prof file
+class session:
+    def __init__(self, gem, part):
+        self.gem = gem
+        self.part = part
+
+    def __enter__(self):
+        _sessions.append(self)
+        self.first = len(_records)
+        self.profile = cProfile.Profile() if _settings['cprofile'] else None
+        self.timer = stage('total').__enter__()
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profile is not None:
+            self.profile.disable()
+        self.timer.__exit__(exc_type, exc_value, traceback)
+        _sessions.pop()
+        records = _records[self.first:]
+        del _records[self.first:]
+        filename = '%s/%s.%s' % (_settings['directory'], self.gem, self.part)
+        write_report(filename + '.json', {'gem': self.gem, 'part': self.part, 'failed': exc_type is not None,
+                                          'records': records})
+        if self.profile is not None:
+            self.profile.dump_stats(filename + '.prof')
+        return False
+
+
+def write_report(filename, report):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+# write the totals of the stages this process ran outside any session to pipeline.json and total every stage of
+# every report (count, seconds, largest peak RSS of the stage and of its process) per GEM and part into summary.csv
+def write_summary():
+    directory = _settings['directory']
+    if len(_pipeline) > 0:
+        write_report(directory + '/pipeline.json', {'gem': '', 'part': 'pipeline', 'failed': False,
+                                                    'records': list(_pipeline.values())})
+    rows = []
+    for f in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        if f.endswith('.json'):
+            with open(directory + '/' + f) as report:
+                report = json.load(report)
+            rows.extend({'gem': report['gem'], 'part': report['part'], 'stage': r['stage'], 'count': r.get('count', 1),
+                         'seconds': r['seconds'], 'peak_rss_mb': r['peak_rss_mb'],
+                         'process_peak_rss_mb': r.get('process_peak_rss_mb', float('nan'))} for r in report['records'])
+    if len(rows) == 0:
+        return None
+    df = pd.DataFrame(rows).groupby(['gem', 'part', 'stage'], sort=False)
+    df = df.agg(count=('count', 'sum'), seconds=('seconds', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'),
+                process_peak_rss_mb=('process_peak_rss_mb', 'max')).reset_index()
+    df.to_csv(directory + '/summary.csv', index=False)
+    return df
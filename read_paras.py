@@ -1,5 +1,7 @@
 import os
 import pandas as pd
+from scores import list_scored
+import solvers
 
 
 def read(input_file):
@@ -22,16 +24,27 @@ def read(input_file):
 
     # The following fields are optional
     optional_fields = {
+        'NUM_RANDOM_DRAWS': 1,  # with ADD_RANDOM_RXNS, number of random draws of reactions per GEM
+        'RANDOM_SEED': None,  # seed of the first random draw; the next draws use the following seeds
         'MIN_PREDICTED_SCORES': 0.9995, # candidate reactions w/ predicted scores below this cutoff are excluded
         'NUM_CPUS': 1,  # number of cpus to use. use -1 if using all cpus
         'EX_SUFFIX': "_e",  # exchange reaction suffix
         'RESOLVE_EGC': True,  # whether resolve energy-generating cycle
+        'SCREEN_EGC': 0,  # 1 to screen the candidates for energy-generating cycles in bulk when one inflates growth
         'OUTPUT_DIRECTORY': "./",  # output file directory
         'OUTPUT_FILENAME': 'suggested_gaps.csv',  # output file name
         'FLUX_CUTOFF': 1e-5,  # cutoff flux for
+        'LOOPLESS_FVA': 'cobra',  # loop removal in FVA: cobra or none
+        'FVA_PROCESSES': 1,  # processes per FVA; only used when GEMs are not simulated in parallel
+        'KEY_RXN_PROCESSES': 1,  # processes for the key-reaction MILPs of a GEM; likewise
         'ANAEROBIC': True,  # anaerobic fermentation?
-        'BATCH_SIZE': 10,  # number of reactions added in a batch
-        'NAMESPACE': 'bigg'  # currently we only support bigg and modelseed
+        'BATCH_SIZE': 10,  # number of reactions added in the first batch
+        'MAX_BATCH_SIZE': 100,  # the batch size adapts to the share of growth-inflating reactions, up to this size
+        'NAMESPACE': 'bigg',  # currently we only support bigg and modelseed
+        'SOLVER': 'auto',  # cplex, hybrid (HiGHS) or glpk; auto picks the first one installed in this order
+        'PROFILE_DIRECTORY': './results/profiles',  # per-GEM timing and memory reports
+        'TRACE_MEMORY': 0,  # 1 to also trace python allocations (slower)
+        'CPROFILE': 0,  # 1 to also write a cProfile dump per GEM
     }
 
     # Keep only fields that are recognizable
@@ -53,11 +66,16 @@ def read(input_file):
     if paras['NAMESPACE'] not in ['bigg', 'modelseed']:
         raise RuntimeError('unrecognized namespace %s.' % (paras['NAMESPACE']))
 
+    # the solver named by SOLVER, or the preferred installed one for auto
+    paras['SOLVER'] = solvers.choose(paras['SOLVER'])
+
+    # loop removal in FVA
+    if paras['LOOPLESS_FVA'] not in ['cobra', 'none']:
+        raise RuntimeError('unrecognized loopless FVA method %s.' % (paras['LOOPLESS_FVA']))
+
     # Find overlaps between GEM_DIRECTORY and GAPFILLED_RXNS_DIRECTORY
     filenames_in_GEM_DIRECTORY = [f.rstrip('.xml') for f in os.listdir(paras['GEM_DIRECTORY']) if f.endswith('.xml')]
-    filenames_in_GAPFILLED_RXNS_DIRECTORY = [
-        f.rstrip('.csv') for f in os.listdir(paras["GAPFILLED_RXNS_DIRECTORY"]) if f.endswith('.csv')
-    ]
+    filenames_in_GAPFILLED_RXNS_DIRECTORY = list_scored(paras["GAPFILLED_RXNS_DIRECTORY"])
     overlapped_gems = list(set(filenames_in_GEM_DIRECTORY).intersection(set(filenames_in_GAPFILLED_RXNS_DIRECTORY)))
     if len(overlapped_gems) == 0:
         raise RuntimeError("cannot find gapfilled reactions for any genome-scale model.")
@@ -0,0 +1,125 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+SUFFIX = '.scores'
+
+
+# append-only columnar store of the scores of one GEM: a directory holding the row index, one
+# memory-mappable .npy file per column and the running sum and count used for the row mean
+class ScoreStore:
+    def __init__(self, path):
+        self.path = path
+        self.meta = {'columns': [], 'count': 0}
+        if os.path.exists(self.path + '/meta.json'):
+            with open(self.path + '/meta.json') as f:
+                self.meta = json.load(f)
+
+    @property
+    def columns(self):
+        return list(self.meta['columns'])
+
+    @property
+    def count(self):
+        return self.meta['count']
+
+    @property
+    def index(self):
+        return np.load(self.path + '/index.npy')
+
+    def column(self, j, mmap_mode='r'):
+        return np.load('%s/column_%d.npy' % (self.path, j), mmap_mode=mmap_mode)
+
+    def append(self, data, index, columns=None):
+        data = np.asarray(data, dtype=np.float32).reshape(len(index), -1)
+        for j, column in enumerate(self.reserve(index, data.shape[1])):
+            column[:] = data[:, j]
+            column.flush()
+        self.commit(data.shape[1], columns)
+
+    # memory-mapped files for the next n columns, to be filled in blocks of rows; they only become part of
+    # the store once commit is called
+    def reserve(self, index, n):
+        index = np.asarray(index, dtype=str)
+        os.makedirs(self.path, exist_ok=True)
+        if self.count == 0:
+            np.save(self.path + '/index.npy', index)
+        elif not np.array_equal(self.index, index):
+            raise RuntimeError('rows of the appended scores do not match the rows of %s.' % self.path)
+        return [np.lib.format.open_memmap('%s/column_%d.npy' % (self.path, self.count + j), mode='w+',
+                                          dtype=np.float32, shape=(len(index),)) for j in range(n)]
+
+    # add the n reserved columns to the store
+    def commit(self, n, columns=None):
+        if columns is None:
+            columns = [str(self.count + j) for j in range(n)]
+        total = np.zeros(len(self.index)) if self.count == 0 else np.load(self.sum_file)
+        for j in range(n):
+            total += self.column(self.count + j)
+        count = self.count + n
+        np.save('%s/sum_%d.npy' % (self.path, count), total)
+
+        # meta.json is written last and names the sum of its count, so an interrupted append leaves the store
+        # unchanged; the previous sum is removed once the new one is committed
+        previous_sum_file = self.sum_file
+        meta = {'columns': self.columns + list(columns), 'count': count, 'sum': 'sum_%d.npy' % count}
+        with open(self.path + '/meta.json.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.path + '/meta.json.tmp', self.path + '/meta.json')
+        self.meta = meta
+        if os.path.exists(previous_sum_file):
+            os.remove(previous_sum_file)
+
+    # stores written before the sum was named in meta.json keep it in sum.npy
+    @property
+    def sum_file(self):
+        return '%s/%s' % (self.path, self.meta.get('sum', 'sum.npy'))
+
+    def mean(self):
+        return pd.Series(np.load(self.sum_file) / self.count, index=self.index)
+
+    def to_frame(self):
+        return pd.DataFrame({c: self.column(j) for j, c in enumerate(self.columns)}, index=self.index)
+
+    def to_csv(self, filename):
+        self.to_frame().to_csv(filename)
+
+
+def store_path(directory, name):
+    return '%s/%s%s' % (directory, name, SUFFIX)
+
+
+def has_store(directory, name):
+    return os.path.exists(store_path(directory, name) + '/meta.json')
+
+
+def write_store(directory, name, df):
+    path = store_path(directory, name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    ScoreStore(path).append(df.values, df.index, [str(c) for c in df.columns])
+
+
+# names of GEMs with scores in a directory, either as a store or as a csv export
+def list_scored(directory):
+    names = set()
+    for f in os.listdir(directory):
+        if f.endswith(SUFFIX) and os.path.exists(directory + '/' + f + '/meta.json'):
+            names.add(f[:-len(SUFFIX)])
+        elif f.endswith('.csv'):
+            names.add(f[:-len('.csv')])
+    return sorted(names)
+
+
+def read_table(directory, name):
+    if has_store(directory, name):
+        return ScoreStore(store_path(directory, name)).to_frame()
+    return pd.read_csv('%s/%s.csv' % (directory, name), index_col=0)
+
+
+def read_mean(directory, name):
+    if has_store(directory, name):
+        return ScoreStore(store_path(directory, name)).mean()
+    return pd.read_csv('%s/%s.csv' % (directory, name), index_col=0).mean(axis=1)
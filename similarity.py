@@ -1,38 +1,150 @@
 import pandas as pd
 from utils import get_data
+from pool import load_pool
+from scores import list_scored, read_mean, write_store
 import numpy as np
-import cobra
-from cobra.util.array import create_stoichiometric_matrix
-import scipy.spatial.distance as distance
-import os
+from scipy import sparse
+import profiler
+from profiler import stage
 
 
-def get_similarity_score(name, top_N):
+# column sums and squared sums of a sparse matrix
+def column_moments(matrix):
+    return np.asarray(matrix.sum(axis=0)).ravel(), np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel()
+
+
+# number of rows touched by any of the matrices
+def count_rows(*matrices):
+    touched = np.zeros(matrices[0].shape[0], dtype=bool)
+    for matrix in matrices:
+        touched[sparse.csc_matrix(matrix).indices] = True
+    return int(touched.sum())
+
+
+# pearson correlations between candidate and model columns measured over num_rows rows, one block of
+# candidates at a time, from sparse dot products and the column moments of both sides
+def correlation_blocks(candidate_matrix, candidate_moments, model_matrix, model_moments, num_rows, chunk_size=1024):
+    model_sum, model_sq_sum = model_moments
+    model_norm = np.sqrt(model_sq_sum - model_sum ** 2 / num_rows)
+    model_matrix_t = model_matrix.T.tocsr()
+    for start in range(0, candidate_matrix.shape[1], chunk_size):
+        block = candidate_matrix[:, start:start + chunk_size]
+        block_sum = candidate_moments[0][start:start + chunk_size]
+        block_norm = np.sqrt(candidate_moments[1][start:start + chunk_size] - block_sum ** 2 / num_rows)
+        covariance = (model_matrix_t @ block).T.toarray() - np.outer(block_sum, model_sum) / num_rows
+        with np.errstate(divide='ignore', invalid='ignore'):
+            yield start, start + block.shape[1], covariance / np.outer(block_norm, model_norm)
+
+
+# index over the reaction profiles of a pool. The column moments of all pool reactions are computed once and
+# shared by the searches of every GEM; centering and normalizing depend on the rows a correlation is measured
+# over, which depend on the GEM, so they are done per search.
+class SimilarityIndex:
+    def __init__(self, pool):
+        self.pool = pool
+        self.sums, self.sq_sums = column_moments(pool.stoichiometric_matrix)
+
+    def moments(self, rxn_ids):
+        position = [self.pool.rxn_index[rid] for rid in rxn_ids]
+        return self.sums[position], self.sq_sums[position]
+
+    # the k reactions of the GEM most correlated (in absolute value) with each candidate pool reaction,
+    # as (correlations, reaction ids), both of shape candidates x k and sorted in decreasing order.
+    # Zero-variance reactions count as uncorrelated. With best_only=True only the best match is returned
+    # (k = 1), with the same correlation as the blocked search, from the pairs sharing a metabolite and
+    # a closed form for the pairs sharing none, so the dense candidate-by-model block is never built.
+    def search(self, extended_pool, candidate_rxns, k=1, best_only=False, chunk_size=1024):
+        model_rxns = np.array(extended_pool.model_reactions)
+        candidate_matrix = extended_pool.columns(candidate_rxns)
+        model_matrix = extended_pool.columns(model_rxns)
+        candidate_moments = self.moments(candidate_rxns)
+        model_moments = column_moments(model_matrix)
+        num_rows = count_rows(candidate_matrix, model_matrix)
+        if best_only:
+            values, indices = self._search_best(candidate_matrix, candidate_moments, model_matrix, model_moments, num_rows)
+            return values, model_rxns[indices]
+
+        k = min(k, len(model_rxns))
+        values = np.empty((len(candidate_rxns), k))
+        indices = np.empty((len(candidate_rxns), k), dtype=np.int64)
+        for start, stop, corr in correlation_blocks(candidate_matrix, candidate_moments, model_matrix, model_moments,
+                                                    num_rows, chunk_size):
+            corr = np.nan_to_num(np.abs(corr), nan=0.0)
+            top = np.argpartition(-corr, k - 1, axis=1)[:, :k]
+            top_values = np.take_along_axis(corr, top, axis=1)
+            order = np.argsort(-top_values, axis=1, kind='stable')
+            indices[start:stop] = np.take_along_axis(top, order, axis=1)
+            values[start:stop] = np.take_along_axis(top_values, order, axis=1)
+        return values, model_rxns[indices]
+
+    # best match of every candidate without the dense block. Two columns without a shared row have covariance
+    # -sum_a * sum_b / R, hence |corr| = |sum_a / norm_a| * |sum_b / norm_b| / R: among the GEM reactions sharing
+    # no metabolite with a candidate, the best is the first one by decreasing |sum_b / norm_b|. Pairs sharing a
+    # metabolite are computed exactly from their sparse dot products.
+    @staticmethod
+    def _search_best(candidate_matrix, candidate_moments, model_matrix, model_moments, num_rows):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            candidate_norm = np.sqrt(candidate_moments[1] - candidate_moments[0] ** 2 / num_rows)
+            model_norm = np.sqrt(model_moments[1] - model_moments[0] ** 2 / num_rows)
+            candidate_scale = np.nan_to_num(np.abs(candidate_moments[0] / candidate_norm), nan=0.0, posinf=0.0)
+            model_scale = np.nan_to_num(np.abs(model_moments[0] / model_norm), nan=0.0, posinf=0.0)
+
+            overlap = (candidate_matrix.T.tocsr() @ model_matrix).tocoo()
+            row, col = overlap.row, overlap.col
+            corr = (overlap.data - candidate_moments[0][row] * model_moments[0][col] / num_rows) / \
+                (candidate_norm[row] * model_norm[col])
+        corr = np.nan_to_num(np.abs(corr), nan=0.0, posinf=0.0)
+
+        # GEM reactions ranked by decreasing scale; the overlapping reactions of a candidate, sorted by rank, take
+        # ranks 0, 1, ... up to its first free rank, which is thus the number of them whose rank equals their
+        # position. A candidate overlapping every GEM reaction has no free one and gets 0 here.
+        ranking = np.argsort(-model_scale, kind='stable')
+        rank = np.empty_like(ranking)
+        rank[ranking] = np.arange(len(ranking))
+        order = np.lexsort((rank[col], row))
+        sorted_row, sorted_rank = row[order], rank[col][order]
+        position = np.arange(len(sorted_row)) - np.searchsorted(sorted_row, sorted_row)
+        first_free = np.bincount(sorted_row[sorted_rank == position], minlength=candidate_matrix.shape[1])
+        indices = ranking[np.minimum(first_free, len(ranking) - 1)]
+        values = np.where(first_free < len(ranking), candidate_scale * model_scale[indices] / num_rows, 0.0)
+
+        # best overlapping pair of every candidate
+        order = np.lexsort((corr, row))
+        row, col, corr = row[order], col[order], corr[order]
+        last = np.append(row[1:] != row[:-1], True) if len(row) > 0 else np.zeros(0, dtype=bool)
+        row, col, corr = row[last], col[last], corr[last]
+        better = corr > values[row]
+        values[row[better]] = corr[better]
+        indices[row[better]] = col[better]
+        return values.reshape(-1, 1), indices.reshape(-1, 1)
+
+
+# top_N=None scores the whole candidate list instead of only the top_N highest predicted reactions. samples, if
+# given, are the GEMs to score instead of all scored ones; callback(sample) is called once a GEM is written.
+def get_similarity_score(name, top_N, best_only=False, samples=None, callback=None):
     path = './results/predicted_scores'
-    all_files = sorted(os.listdir(path))
-    model_pool = cobra.io.read_sbml_model('./data/pools/bigg_universe.xml')
-
-    for sample in all_files:
-        if sample.endswith('csv'):
-            model_pool_copy = model_pool.copy()
-            scores = pd.read_csv(path +'/' + sample, index_col=0).mean(axis=1).sort_values(ascending=False)
-            model = get_data('./data/' + name, sample[:-4] + '.xml')[0]
-            rxns = [rxn.id for rxn in model.reactions]
-            model_pool_copy.merge(model)
-            model_pool_df = create_stoichiometric_matrix(model_pool_copy, array_type='DataFrame')
+    model_pool = load_pool('./data/pools/bigg_universe.xml')
+    similarity_index = SimilarityIndex(model_pool)
+
+    for sample in list_scored(path) if samples is None else samples:
+        with profiler.session(sample, 'similarity'):
+            scores = read_mean(path, sample).sort_values(ascending=False)
+            model = get_data('./data/' + name, sample + '.xml')[0]
+            extended_pool = model_pool.extend(model)
 
             candidate_rxns = scores.index.tolist()[:top_N]
-            candidate_matrix = model_pool_df[candidate_rxns].values
-            model_matrix = model_pool_df[rxns].values
-            feature = np.concatenate((candidate_matrix, model_matrix), axis=1)
-            feature = feature[np.sum(np.abs(feature), axis=1) > 0, :]
-            corr_matrix = np.abs(1 - distance.cdist(feature.T, feature.T, 'correlation'))
-            similarity_max = corr_matrix[:candidate_matrix.shape[1], candidate_matrix.shape[1]:].max(axis=1)
+            with stage('similarity'):
+                similarity_max = similarity_index.search(extended_pool, candidate_rxns, best_only=best_only)[0][:, 0]
 
             predicted_scores = scores.loc[candidate_rxns].values
             all_scores = np.concatenate((predicted_scores.reshape(-1, 1), similarity_max.reshape(-1, 1)), axis=1)
             all_scores_df = pd.DataFrame(data=all_scores, index=candidate_rxns, columns=['predicted_scores', 'similarity_scores'])
-            all_scores_df.to_csv('./results/similarity_scores/' + sample)
+            write_store('./results/similarity_scores', sample, all_scores_df)
+            all_scores_df.to_csv('./results/similarity_scores/' + sample + '.csv')
+        if callback is not None:
+            callback(sample)
+
+    profiler.write_summary()
 
 
 #if __name__ == "__main__":
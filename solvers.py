@@ -0,0 +1,78 @@
+import optlang
+from optlang.interface import OPTIMAL
+
+# solvers in order of preference for SOLVER = auto; hybrid is HiGHS through optlang (optlang >= 1.8 with highspy and
+# osqp, as pinned in requirements.txt)
+PREFERENCE = ['cplex', 'hybrid', 'glpk']
+
+# per-solver settings: the configuration applied to every model, the LP settings tried in turn when a solve is not
+# optimal, and the MIP integrality tolerances tried in turn. The cplex profile keeps the cplex defaults, so its
+# results are those of the cplex-only pipeline.
+PROFILES = {
+    'cplex': {
+        'configuration': {},
+        'lp_fallbacks': [{'lp_method': lp_method} for lp_method in
+                         ['primal', 'dual', 'network', 'barrier', 'sifting', 'concurrent']],
+        'integrality_tolerances': [1e-9, 1e-8, 1e-7, 1e-6],
+    },
+    'hybrid': {
+        'configuration': {'presolve': 'auto'},
+        'lp_fallbacks': [{'lp_method': 'simplex'}, {'lp_method': 'interior point'}, {'presolve': False}],
+        'integrality_tolerances': [1e-9, 1e-8, 1e-7, 1e-6],
+    },
+    # GLPK has no equivalent of the cplex lp_method cycle: optlang's GLPK interface exposes no LP method (its
+    # simplex is always primal, and GLPK's interior-point solver is not reachable from optlang) and GLPK runs
+    # on a single thread. Presolve is the only setting left to retry with; optlang itself already retries an
+    # undefined solve from an advanced basis and, for a MIP, with presolve.
+    'glpk': {
+        'configuration': {'presolve': 'auto'},
+        'lp_fallbacks': [{'presolve': True}, {'presolve': False}],
+        'integrality_tolerances': [1e-9, 1e-8, 1e-7, 1e-6],
+    },
+}
+
+
+def available():
+    return [name for name in PREFERENCE if hasattr(optlang, name + '_interface')]
+
+
+# the solver to use for the SOLVER field: auto picks the first available one in PREFERENCE
+def choose(name='auto'):
+    names = available()
+    if name == 'auto':
+        if len(names) == 0:
+            raise RuntimeError('none of the solvers %s found.' % ', '.join(PREFERENCE))
+        return names[0]
+    if name not in PROFILES:
+        raise RuntimeError('unsupported solver %s.' % name)
+    if name not in names:
+        raise RuntimeError('%s not found.' % name)
+    return name
+
+
+# name of the solver of a model, e.g. glpk for optlang.glpk_interface
+def solver_name(model):
+    return model.solver.interface.__name__.split('.')[-1][:-len('_interface')]
+
+
+def configure(model, name):
+    model.solver = name
+    for key, value in PROFILES[name]['configuration'].items():
+        setattr(model.solver.configuration, key, value)
+
+
+# optimize the model, trying the fallback LP settings of its solver in turn if the solution is not optimal; the
+# settings that worked stay on the model
+def optimize(model):
+    solution = model.optimize()
+    for settings in PROFILES.get(solver_name(model), {'lp_fallbacks': []})['lp_fallbacks']:
+        if model.solver.status == OPTIMAL:
+            break
+        for key, value in settings.items():
+            setattr(model.solver.configuration, key, value)
+        solution = model.optimize()
+    return solution
+
+
+def integrality_tolerances(model):
+    return PROFILES.get(solver_name(model), PROFILES['glpk'])['integrality_tolerances']
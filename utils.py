@@ -4,9 +4,9 @@ import numpy as np
 import pandas as pd
 import networkx as nx
 import cobra
-import math
 from node2vec import Node2Vec
-from cobra.util.array import create_stoichiometric_matrix
+from pool import load_pool, get_stoichiometric_matrix
+from profiler import stage
 from cobra.util.solver import linear_reaction_coefficients
 import warnings
 import re
@@ -19,7 +19,8 @@ def get_filenames(path):
 
 
 def get_data(path, sample):
-    model = cobra.io.read_sbml_model(path + '/' + sample)
+    with stage('load_sbml'):
+        model = cobra.io.read_sbml_model(path + '/' + sample)
     if path[-4:] == 'bigg':
         biomass_rxns = np.array(pd.read_csv('./data/pools/bigg_biomass_reactions.csv').bigg_id.to_list())
         rxns = np.array([rxn.id for rxn in model.reactions])
@@ -35,17 +36,16 @@ def get_data(path, sample):
         remove_ex_rxn_index = [rxns.index(ex_rxn) for ex_rxn in ex_rxns]
         ex_rxns = [model.reactions[index] for index in remove_ex_rxn_index]
         model.remove_reactions(ex_rxns, remove_orphans=True)
-    stoichiometric_matrix = create_stoichiometric_matrix(model)
-    incidence_matrix = np.abs(stoichiometric_matrix) > 0
-    remove_rxn_index = np.sum(incidence_matrix, axis=0) <= 1
+    incidence_matrix = get_stoichiometric_matrix(model) != 0
+    remove_rxn_index = np.diff(incidence_matrix.indptr) <= 1
     model.remove_reactions(model.reactions[remove_rxn_index], remove_orphans=True)
-    return model, np.abs(create_stoichiometric_matrix(model)) > 0
+    return model, get_stoichiometric_matrix(model) != 0
 
 
 def create_pool(name):
     path = './data/'+ name
     namelist = get_filenames(path)
-    model_pool = cobra.io.read_sbml_model('./data/pools/bigg_universe.xml')
+    model_pool = load_pool('./data/pools/bigg_universe.xml').model
     for sample in namelist:
         if sample.endswith('xml'):
             model = get_data(path, sample)[0]
@@ -69,32 +69,100 @@ def get_data_from_pool(path, sample, model_pool_df, rxns_w_genes):
     return model_df, model_pool_df[cols2use], added_rxns
 
 
-def get_data_from_pool2(path, sample, model_pool):
+# returns sparse stoichiometric columns of the model reactions and of the remaining pool reactions
+def get_data_from_pool2(path, sample, pool):
     model = get_data(path, sample)[0]
-    rxns = np.array([rxn.id for rxn in model.reactions])
-    model_pool.merge(model)
-    model_pool_df = create_stoichiometric_matrix(model_pool, array_type='DataFrame')
-    model_df = model_pool_df[rxns]
-    cols2use = model_pool_df.columns.difference(model_df.columns)
-    return model_df, model_pool_df[cols2use]
+    rxns = [rxn.id for rxn in model.reactions]
+    extended_pool = pool.extend(model)
+    rxn_pool_matrix, rxn_pool = extended_pool.candidates()
+    return extended_pool.columns(rxns), rxn_pool_matrix, rxn_pool
+
+
+# convert a scipy sparse stoichiometric matrix to a sparse torch incidence matrix
+def create_incidence_matrix(stoichiometric_matrix, dtype=torch.float):
+    stoichiometric_matrix = stoichiometric_matrix.tocoo()
+    indices = torch.tensor(np.vstack((stoichiometric_matrix.row, stoichiometric_matrix.col)), dtype=torch.int64)
+    values = torch.ones(stoichiometric_matrix.nnz, dtype=dtype)
+    return torch.sparse_coo_tensor(indices, values, stoichiometric_matrix.shape).coalesce()
 
 
+# (node, hyperedge) pairs ordered by hyperedge, then by node
 def create_hyperedge_index(incidence_matrix):
+    if incidence_matrix.is_sparse:
+        incidence_matrix = incidence_matrix.coalesce()
+        row, col = incidence_matrix.indices()[:, incidence_matrix.values() != 0]
+        order = torch.argsort(col * incidence_matrix.shape[0] + row)
+        return torch.stack((row[order], col[order]), dim=0)
     row, col = torch.where(incidence_matrix.T)
     hyperedge_index = torch.cat((col.view(1, -1), row.view(1, -1)), dim=0)
     return hyperedge_index
 
 
+def select_columns(incidence_matrix, columns):
+    if not incidence_matrix.is_sparse:
+        return incidence_matrix[:, columns]
+    columns = torch.as_tensor(columns, dtype=torch.int64)
+    incidence_matrix = incidence_matrix.coalesce()
+    row, col = incidence_matrix.indices()
+    position = torch.full((incidence_matrix.shape[1],), -1, dtype=torch.int64)
+    position[columns] = torch.arange(len(columns))
+    keep = position[col] >= 0
+    indices = torch.stack((row[keep], position[col[keep]]), dim=0)
+    shape = (incidence_matrix.shape[0], len(columns))
+    return torch.sparse_coo_tensor(indices, incidence_matrix.values()[keep], shape).coalesce()
+
+
+# drop duplicated hyperedges; for sparse matrices, columns are compared by their padded node lists
+def unique_columns(incidence_matrix):
+    if not incidence_matrix.is_sparse:
+        return torch.unique(incidence_matrix, dim=1)
+    num_edges = incidence_matrix.shape[1]
+    if num_edges == 0:
+        return incidence_matrix
+    nodes, edges = create_hyperedge_index(incidence_matrix)
+    degree = torch.bincount(edges, minlength=num_edges)
+    ptr = torch.cumsum(degree, dim=0) - degree
+    padded = torch.full((num_edges, int(degree.max())), -1, dtype=torch.int64)
+    padded[edges, torch.arange(len(edges)) - ptr[edges]] = nodes
+    inverse = torch.unique(padded, dim=0, return_inverse=True)[1]
+    first = torch.zeros(int(inverse.max()) + 1, dtype=torch.int64).scatter_(0, inverse, torch.arange(num_edges))
+    return select_columns(incidence_matrix, first)
+
+
+# a negative hyperedge keeps a random half of the nodes of a positive hyperedge and replaces
+# the other half by nodes outside it; all hyperedges are sampled at once
 def create_neg_incidence_matrix(incidence_matrix):
-    incidence_matrix_neg = torch.zeros(incidence_matrix.shape)
-    for i, edge in enumerate(incidence_matrix.T):
-        nodes = torch.where(edge)[0]
-        nodes_comp = torch.tensor(list(set(range(len(incidence_matrix))) - set(nodes.tolist())))
-        edge_neg_l = torch.tensor(np.random.choice(nodes, math.floor(len(nodes) * 0.5), replace=False))
-        edge_neg_r = torch.tensor(np.random.choice(nodes_comp, len(nodes) - math.floor(len(nodes) * 0.5), replace=False))
-        edge_neg = torch.cat((edge_neg_l, edge_neg_r))
-        incidence_matrix_neg[edge_neg, i] = 1
-    return incidence_matrix_neg
+    num_nodes, num_edges = incidence_matrix.shape
+    nodes, edges = create_hyperedge_index(incidence_matrix)
+    degree = torch.bincount(edges, minlength=num_edges)
+    num_kept = torch.div(degree, 2, rounding_mode='floor')
+    num_comp = degree - num_kept
+    if bool((num_comp > num_nodes - degree).any()):
+        raise RuntimeError('cannot sample negative hyperedges: a hyperedge covers more than half of the nodes.')
+
+    # random half of each hyperedge: shuffle nodes within each hyperedge segment and keep the leading ones
+    ptr = torch.cumsum(degree, dim=0) - degree
+    order = torch.argsort(edges.double() + torch.rand(len(edges), dtype=torch.double))
+    rank = torch.arange(len(edges)) - ptr[edges]
+    kept = order[rank < num_kept[edges]]
+
+    # nodes outside each hyperedge by rejection sampling, keyed as hyperedge * num_nodes + node
+    member = edges * num_nodes + nodes
+    sampled = torch.empty(0, dtype=torch.int64)
+    pending = torch.repeat_interleave(torch.arange(num_edges), num_comp)
+    while len(pending) > 0:
+        keys = pending * num_nodes + torch.randint(num_nodes, (len(pending),))
+        position = torch.searchsorted(member, keys).clamp(max=max(len(member) - 1, 0))
+        keys = keys[member[position] != keys] if len(member) > 0 else keys
+        sampled = torch.unique(torch.cat((sampled, keys)))
+        missing = num_comp - torch.bincount(torch.div(sampled, num_nodes, rounding_mode='floor'), minlength=num_edges)
+        pending = torch.repeat_interleave(torch.arange(num_edges), missing)
+
+    node_neg = torch.cat((nodes[kept], sampled % num_nodes))
+    edge_neg = torch.cat((edges[kept], torch.div(sampled, num_nodes, rounding_mode='floor')))
+    indices = torch.stack((node_neg, edge_neg), dim=0)
+    incidence_matrix_neg = torch.sparse_coo_tensor(indices, torch.ones(indices.shape[1]), incidence_matrix.shape)
+    return incidence_matrix_neg.coalesce() if incidence_matrix.is_sparse else incidence_matrix_neg.to_dense()
 
 
 def hyperlink_score_loss(y_pred, y):
@@ -104,9 +172,31 @@ def hyperlink_score_loss(y_pred, y):
     return loss
 
 
+# area under the roc curve from the ranks of the scores (ties share their mean rank)
+def auc_score(y_pred, y):
+    y_pred, y = y_pred.view(-1).double(), y.view(-1)
+    num_pos, num_neg = int((y == 1).sum()), int((y == 0).sum())
+    if num_pos == 0 or num_neg == 0:
+        return float('nan')
+    values, inverse, counts = torch.unique(y_pred, return_inverse=True, return_counts=True)
+    rank = (torch.cumsum(counts, dim=0) - (counts - 1) / 2.0)[inverse]
+    return float((rank[y == 1].sum() - num_pos * (num_pos + 1) / 2.0) / (num_pos * num_neg))
+
+
+# hold out hyperedges for validation, training and validation sizes in the ratio train_size : test_size
+def split_hyperlinks(incidence_matrix, train_size, test_size):
+    num_edges = incidence_matrix.shape[1]
+    num_val = round(num_edges * test_size / (train_size + test_size))
+    if num_val < 1 or num_val >= num_edges:
+        raise RuntimeError('cannot hold out %d of %d hyperedges for validation.' % (num_val, num_edges))
+    shuffle_index = torch.randperm(num_edges)
+    train_index, val_index = shuffle_index[num_val:].sort()[0], shuffle_index[:num_val].sort()[0]
+    return select_columns(incidence_matrix, train_index), select_columns(incidence_matrix, val_index)
+
+
 def create_label(incidence_matrix_pos, incidence_matrix_neg):
-    y_pos = torch.ones(len(incidence_matrix_pos.T))
-    y_neg = torch.zeros(len(incidence_matrix_neg.T))
+    y_pos = torch.ones(incidence_matrix_pos.shape[1])
+    y_neg = torch.zeros(incidence_matrix_neg.shape[1])
     return torch.cat((y_pos, y_neg))
 
 
@@ -1,23 +1,58 @@
-import cobra
-import optlang
 import os
 import pandas as pd
-from copy import deepcopy
-from joblib import Parallel, delayed
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import read_paras
 import fba
+import solvers
+from pool import load_pool
+from scores import read_table
+import profiler
 import sys
 import warnings
 
 warnings.filterwarnings("ignore")
 
 
-def validate():
-    # we currently only support cplex
-    solvers = [match.split("_interface")[0] for match in dir(optlang) if "_interface" in match]
-    if "cplex" not in solvers:
-        raise RuntimeError("cplex not found.")
+def load_universe(pool_file, solver):
+    universe = load_pool(pool_file).model
+    solvers.configure(universe, solver)
+    return universe
+
+
+# each worker process loads the reaction pool once (from the pool cache) instead of receiving it with every GEM
+_worker_universe = None
+
+
+def _init_worker(pool_file, solver):
+    global _worker_universe
+    _worker_universe = load_universe(pool_file, solver)
+
+
+def _predict_fermentation_worker(gem_file, paras):
+    return fba.predict_fermentation(gem_file, _worker_universe, paras)
+
+
+# expected cost of simulating a GEM: its size times the number of candidate reactions gap-filling can add (in all
+# random draws)
+def expected_cost(gem_file, paras):
+    size = os.path.getsize('%s/%s.xml' % (paras['GEM_DIRECTORY'], gem_file))
+    num_rxns_to_fill = int(paras['NUM_GAPFILLED_RXNS_TO_ADD'])
+    if int(paras['ADD_RANDOM_RXNS']):
+        return size * num_rxns_to_fill * int(paras['NUM_RANDOM_DRAWS'])
+    df_gapfill = read_table(paras['GAPFILLED_RXNS_DIRECTORY'], gem_file)
+    num_candidates = int((df_gapfill['predicted_scores'] >= float(paras['MIN_PREDICTED_SCORES'])).sum())
+    return size * (1 + min(num_candidates, num_rxns_to_fill))
+
+
+# number of worker processes for NUM_CPUS, negative values counting back from all cpus as in joblib
+def num_workers(num_cpus):
+    num_cpus = int(num_cpus)
+    if num_cpus < 0:
+        num_cpus = os.cpu_count() + 1 + num_cpus
+    return max(1, num_cpus)
+
 
+def validate():
     # read in arguments
     if len(sys.argv) > 2:
         raise RuntimeError('at most one parameter is supplied.')
@@ -33,27 +68,49 @@ def validate():
 
     # read input parameters
     paras = read_paras.read(input_file)
-
-    # load reaction pools
-    universe = cobra.io.read_sbml_model(paras['REACTION_POOL'])
-    universe.solver = 'cplex'
+    print('validate: using solver %s' % paras['SOLVER'])
 
     # ***********************************************************************
     # add gapfilled reactions or random reactions selected from reaction pools
     # ***********************************************************************
-
-    # compute fermentation flux
     print('-------------------------------------------------------')
-    df_output = None
-    retLst = Parallel(n_jobs=int(paras['NUM_CPUS']))(
-        delayed(fba.predict_fermentation)(gem_file, universe, paras) for gem_file in paras['GEMs'].split(';')
-    )
-    if df_output is None:
-        df_output = deepcopy(pd.concat(retLst))
-    else:
-        df_output = pd.concat([df_output, pd.concat(retLst)])
 
-    # write intermediate results to file
+    # results are appended to the output file as each GEM finishes
     output_file: str = "%s/%s" % (paras['OUTPUT_DIRECTORY'], paras['OUTPUT_FILENAME'])
-    df_output.to_csv(output_file, index=False)
+    if os.path.exists(output_file):
+        os.remove(output_file)
+
+    def write_result(gem_file, df):
+        df.to_csv(output_file, mode='a', header=not os.path.exists(output_file), index=False)
+
+    simulate(paras, paras['GEMs'].split(';'), write_result)
+    profiler.write_summary()
     print('done!')
+
+
+# compute fermentation flux of the GEMs, in NUM_CPUS worker processes; callback(gem_file, df) is called with the
+# results of each GEM as soon as it finishes
+def simulate(paras, gem_files, callback):
+    # the workers configure their own profiler; this one writes the summary of their reports
+    profiler.configure(paras['PROFILE_DIRECTORY'], int(paras['TRACE_MEMORY']), int(paras['CPROFILE']))
+
+    # FVA and the key-reaction MILPs fan out across processes only when the GEMs are not simulated in parallel
+    workers = min(num_workers(paras['NUM_CPUS']), len(gem_files))
+    if workers > 1:
+        paras = dict(paras, FVA_PROCESSES=1, KEY_RXN_PROCESSES=1)
+
+    if workers <= 1:
+        # load reaction pools
+        universe = load_universe(paras['REACTION_POOL'], paras['SOLVER'])
+        for gem_file in gem_files:
+            callback(gem_file, fba.predict_fermentation(gem_file, universe, paras))
+    else:
+        # the most expensive GEMs first, so that no long simulation is left for the end
+        gem_files = sorted(gem_files, key=lambda gem_file: expected_cost(gem_file, paras), reverse=True)
+        # build the pool cache once here, so the workers read it instead of all parsing the sbml file at once
+        load_pool(paras['REACTION_POOL'])
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(paras['REACTION_POOL'], paras['SOLVER'])) as executor:
+            futures = {executor.submit(_predict_fermentation_worker, gem_file, paras): gem_file for gem_file in gem_files}
+            for future in as_completed(futures):
+                callback(futures[future], future.result())